@@ -13,6 +13,7 @@
 #limitations under the License.
 
 import os
+import argparse
 import shutil
 import geopandas as gpd
 import pandas as pd
@@ -21,389 +22,581 @@ from shapely import wkt
 from shapely.geometry import Point
 import sys
 import yaml
-import subprocess
 import h5py
 from pathlib import Path
+import allocation
+import h5_io
+import parcel_io
+import popsim_runner
+import daysim_recode
+import stage_cache
+import profiling
+import preflight
+import schema
+import table_index
+import parcel_export
+import control_tables
+
+emp_cols = schema.emp_cols
+
+
+def update_controls(config, df_allocate, popsim_run_dir_path):
+    """Update future_controls.csv with household and person totals from user_allocation.csv
+
+    Category controls are set from regional shares times the zone totals and integerized per
+    zone with largest remainder, so each group of categories binning the same attribute (as
+    defined in control_bins.csv) sums exactly to the zone's households or persons.
+    """
+
+    df = pd.read_csv(popsim_run_dir_path/'data'/'future_controls.csv')
+    col_list = ['taz_id']
+    if config['update_hh']:
+        col_list += ['households']
+    if config['update_persons']:
+        col_list += ['persons']
+
+    df = df_allocate[col_list].merge(df, how='left', on='taz_id')   # Join only zones from user_allocation.csv
+
+    # regional household totals for control calculations
+    tot_hh = df['hh_taz_weight'].sum()
+    tot_person = df['pers_taz_weight'].sum()
+
+    # Use average household size if number of persons not specified in user_allocation.csv
+    if config['update_hh']:
+        df['hh_taz_weight'] = df['households']
+    if config['update_persons']:
+        no_persons = df['persons'].isna() | (df['persons'] == 0)
+        df['pers_taz_weight'] = np.where(no_persons, df['hh_taz_weight'] * config['average_hh_size'], df['persons'])
+    households = df['hh_taz_weight'].fillna(0).to_numpy(dtype='float64')
+    persons = np.round(df['pers_taz_weight'].fillna(0).to_numpy(dtype='float64'))
+    df['pers_taz_weight'] = persons
+
+    # Categories of the same attribute are integerized together; other controls on their own
+    bins = control_tables.read_control_bins('control_bins.csv')
+    attribute = bins.set_index('control_field')['column']
+    for cols, totals, regional_total in [(config['household_cols'], households, tot_hh),
+                                         (config['person_cols'], persons, tot_person)]:
+        if len(cols) == 0:
+            continue
+        # Regional share of each category in the existing controls
+        shares = np.nansum(df[cols].to_numpy(dtype='float64'), axis=0) / regional_total
+        for col, share in zip(cols, shares):
+            print(col, regional_total, share)
+        target = totals[:, None] * shares[None, :]
+        col_group = pd.factorize(attribute.reindex(cols).fillna(pd.Series(cols, index=cols)))[0]
+        n_groups = col_group.max() + 1
+        group = (np.arange(len(df))[:, None] * n_groups + col_group[None, :]).ravel()
+        group_totals = np.round(np.bincount(group, weights=target.ravel(), minlength=len(df) * n_groups))
+        df[cols] = allocation.largest_remainder(target.ravel(), group, group_totals).reshape(target.shape)
+
+    df.drop([col for col in ['households', 'persons'] if col in df.columns], axis=1, inplace=True)
+
+    ## Enforce integers
+    df.fillna(0, inplace = True)
+    df = df.astype('int')
+    df.to_csv(popsim_run_dir_path/'data'/'future_controls.csv', index=False)
+
+    return df
+
+
+def read_parcels(config):
+    """Load the Soundcast parcel file, applying manual TAZ assignments from config"""
+
+    land_use_path = Path(config['input_land_use_path'])
+    parcels = parcel_io.load_parcels(land_use_path/'parcels_urbansim.txt')
+    if config['manual_xwalk'] is not None:
+        parcel_manual_dict = config['manual_xwalk']
+        parcels['updated_taz'] = parcels['parcelid'].map(parcel_manual_dict)
+        parcels['taz_p'] = np.where(~parcels.updated_taz.isna(), parcels.updated_taz, parcels.taz_p)
+        parcels = parcels.drop('updated_taz',axis = 1)
+    parcels.columns = [col.lower() for col in parcels.columns]
+    if config['use_capacities'] and ('hh_u' not in parcels.columns):
+        print("No Capacities set, please include the column 'hh_u' in the parcel file to indicate the housing capacity")
+        sys.exit()
+    elif not config['use_capacities']:
+        parcels['hh_u'] = 0
+
+    return schema.apply_schema(parcels, schema.parcel_dtypes)
+
+
+def load_base_data(config, synthetic=None, parcels=None):
+    """Load parcels, synthetic population and existing household IDs shared by all scenarios
+
+    synthetic holds the synthetic households and persons of an in-process PopulationSim run;
+    otherwise they are read from the PopulationSim output folder. parcels, if given, is a parcel
+    table already loaded with read_parcels.
+    """
+
+    popsim_run_dir_path = Path(config['output_dir'])
+    land_use_path = Path(config['input_land_use_path'])
+    base = {}
+    base['parcels'] = read_parcels(config) if parcels is None else parcels
+    if synthetic is None:
+        synthetic = (pd.read_csv(popsim_run_dir_path/'output'/'synthetic_households.csv'),
+                     pd.read_csv(popsim_run_dir_path/'output'/'synthetic_persons.csv'))
+    base['synth_hhs'] = schema.apply_schema(synthetic[0], schema.synth_household_dtypes)
+    base['synth_persons'] = schema.apply_schema(synthetic[1], schema.synth_person_dtypes)
+    # Load persons and households table from model run
+    # This file will be modified/replaced by new results from synthetic households 
+    # Only the household IDs are needed until export; other records are read by TAZ when writing results
+    myh5 = h5py.File(land_use_path/'hh_and_persons.h5','r')
+    base['max_hhno'] = h5_io.read_h5_table(myh5, 'Household', ['hhno'])['hhno'].max()
+    myh5.close()
+    base['recode_rules'] = daysim_recode.read_recode_rules('daysim_recode.csv')
+    base['index'] = base_indexes(base['parcels'], base['synth_hhs'])
+
+    return base
+
+
+def base_indexes(parcels, synth_hhs):
+    """Parcel row by parcelid, parcel rows by TAZ and synthetic household row by household_id"""
+
+    return {'parcel': table_index.build_index(parcels['parcelid']),
+            'taz': table_index.build_index(parcels['taz_p']),
+            'household': table_index.build_index(synth_hhs['household_id'])}
+
+
+def read_override(path, parcels, index=None):
+    """Load manual parcel overrides and attach the TAZ of each parcel"""
+
+    override = pd.read_csv(path)
+    parcel_index = index['parcel'] if index is not None else table_index.build_index(parcels['parcelid'])
+    rows = table_index.lookup_rows(parcel_index, override['parcelid'])
+
+    return table_index.join(override, parcels[['taz_p']], rows)
+
+
+def apply_parcel_weights(parcels, pcl_wgt):
+    """Scale parcel households and jobs by user-supplied parcel weights"""
 
-os.chdir(r'C:\Users\hannah.carson\OneDrive - Resource Systems Group, Inc\PierceCounty\psrc_landuse_allocator\Task_landuse_allocator')
-# Copy user inputs to and set up populationsim directory
-config = yaml.safe_load(open("config.yaml"))
-popsim_run_dir_path = Path(config['output_dir'])
-shutil.copyfile('populationsim_settings.yaml', popsim_run_dir_path/'configs'/'settings.yaml')
-#shutil.copyfile('populationsim_settings_mp.yaml', popsim_run_dir_path/'configs'/'settings_mp.yaml')
-shutil.copyfile('controls.csv', popsim_run_dir_path/'configs'/'controls.csv')
-
-# Set up other paths
-land_use_path = Path(config['input_land_use_path'])
-df_allocate = pd.read_csv(popsim_run_dir_path/'data'/'user_allocation.csv')
-
-if not config['allocation_only']:
-    # Update controls from allocation file before running popsim:
-    if config['update_hh'] or config['update_person']:
-        df = pd.read_csv(popsim_run_dir_path/'data'/'future_controls.csv')
-        col_list = ['taz_id']
-        if config['update_hh']:
-            col_list += ['households']
-        if config['update_persons']:
-            col_list += ['persons']
-
-        df = df_allocate[col_list].merge(df, how='left', on='taz_id')   # Join only zones from user_allocation.csv
-
-        # for zones without existing distributions and user-specified targets, use regional averages
-        update_tazs = df['taz_id']
-        
-        # Use average household size of 2.0 if number of persons not specified in user_allocation.csv
-        df.loc[(df['taz_id'].isin(update_tazs)) &((df['persons'].isna()) |(df['persons'] == 0)), 'persons'] = df['households']*config['average_hh_size']
-
-        # regional household totals for control calculations
-        tot_hh = df.loc[df['taz_id'].isin(update_tazs), 'hh_taz_weight'].sum()
-        tot_person = df.loc[df['taz_id'].isin(update_tazs), 'pers_taz_weight'].sum()
-
-        for col in config['household_cols']:
-            print(col, tot_hh, df[col].sum()/tot_hh)
-            df.loc[df['taz_id'].isin(update_tazs), col] = (df['households']*(df[col].sum()/tot_hh)).astype('int')
-        for col in config['person_cols']:
-            print(col)
-            df.loc[df['taz_id'].isin(update_tazs), col] = (df['persons']*(df[col].sum()/tot_person)).astype('int')
-
-        if config['update_hh']:
-            df['hh_taz_weight'] = df['households'].copy()
-            df.drop(['households'], axis=1, inplace=True)
-        if config['update_persons']:
-            df['pers_taz_weight'] = df['persons'].copy()
-            df.drop(['persons'], axis=1, inplace=True)
-
-        ## Enforce integers
-        df.fillna(0, inplace = True)
-        df = df.astype('int')
-        df.to_csv(popsim_run_dir_path/'data'/'future_controls.csv', index=False)
-
-    # Run populationsim with controls for study area
-    returncode = subprocess.call([sys.executable, 'run_populationsim.py', '-w', config['output_dir']])
-    if returncode != 0:
-        sys.exit(1)
-
-# Load data
-parcels = pd.read_csv(land_use_path/'parcels_urbansim.txt', delim_whitespace=True)
-if config['manual_xwalk'] is not None:
-    parcel_manual_dict = config['manual_xwalk']
-    parcels['updated_taz'] = parcels['parcelid'].map(parcel_manual_dict)
-    parcels['taz_p'] = np.where(~parcels.updated_taz.isna(), parcels.updated_taz, parcels.taz_p)
-    parcels = parcels.drop('updated_taz',axis = 1)
-parcels.columns = [col.lower() for col in parcels.columns]
-synth_hhs = pd.read_csv(popsim_run_dir_path/'output'/'synthetic_households.csv')
-synth_persons = pd.read_csv(popsim_run_dir_path/'output'/'synthetic_persons.csv')
-manual_override = False
-use_capacities = config['use_capacities']
-if config['allocation_override'] is not None:
-    override = pd.read_csv(popsim_run_dir_path/'..'/config['allocation_override'])
-    override = override.merge(parcels[['parcelid','taz_p']], how = 'left', on = 'parcelid')
-    manual_override = True
-if config['parcel_weights'] is not None:
-    emp_cols = ['empedu_p', 'empfoo_p', 'empgov_p', 'empind_p', 'empmed_p','empofc_p', 'empoth_p', 'empret_p', 'emprsc_p', 'empsvc_p']
-
-    pcl_wgt = pd.read_csv(popsim_run_dir_path/'..'/config['parcel_weights'])
+    pcl_wgt = pcl_wgt.copy()
     pcl_wgt['weight'] = pcl_wgt['weight'] +1
-    parcels = parcels.merge(pcl_wgt, how = 'left', on = 'parcelid')
-    parcels = parcels.fillna(1)
-    parcels['hh_p'] = parcels['hh_p']*(parcels['weight'])
-    parcels['hh_p'] = parcels['hh_p'].apply(round)
-    parcels[emp_cols] = parcels[emp_cols].multiply(parcels['weight'], axis = 'index')
-    parcels[emp_cols] = parcels[emp_cols].apply(round)# Load persons and households table from model run
-# This file will be modified/replaced by new results from synthetic households 
-myh5 = h5py.File(land_use_path/'hh_and_persons.h5','r')
-old_h5_hh = pd.DataFrame()
-for col in myh5['Household'].keys():
-    old_h5_hh[col] = myh5['Household'][col][:]
-
-old_h5_person = pd.DataFrame()
-for col in myh5['Person'].keys():
-    old_h5_person[col] = myh5['Person'][col][:]
-
-# Households from the newly generated synthetic household file are allocated to parcels
-# based on existing household distributions with TAZs. Parcels with more households are more likely
-# to recieve new households (within a TAZ).
-df_list = []
-if use_capacities and ('hh_u' not in parcels.columns):
-   print("No Capacities set, please include the column 'hh_u' in the parcel file to indicate the housing capacity")
-   sys.exit()
-elif not use_capacities:
-    parcels['hh_u'] = 0
-for taz in synth_hhs['taz_id'].unique():
-    # Select all of the newly generated synthetic households assigned to a TAZ
-    taz_df = synth_hhs[synth_hhs['taz_id']==taz][['taz_id', 'hh_id', 'household_id']]
-    taz_parcels = parcels.loc[parcels['taz_p']==taz]
-    if use_capacities:
-        taz_parcels.loc[(taz_parcels['hh_u'] > 0) & (taz_parcels['hh_p'] == 0), 'hh_p'] = .0001
-    if taz_parcels['hh_p'].sum()==0:
-        # if no exisiting HHs in TAZ, assign uniform distribution; one hh for each parcel
-        taz_parcels['hh_p'] = 1
-    if manual_override:
-        for parcel in override[override.taz_p == taz].parcelid.unique():
-            parcel_override_val = override.loc[override['parcelid'] == parcel].hh_p.item()
-            if np.isnan(parcel_override_val):
-                continue
-            try:
-                parcel_override = taz_df.sample(parcel_override_val, random_state = 5)
-            except:
-                print("Check that manual override in parcel {} does not exceed total households in TAZ {}".format(parcel, taz))
-                sys.exit()
-            parcel_override['parcelid'] = parcel
-            parcel_override['taz_p'] = taz
-            df_list.append(parcel_override)
-            taz_df = taz_df[~(taz_df.household_id.isin(parcel_override.household_id.unique()))]
-            taz_parcels = taz_parcels[~(taz_parcels.parcelid == parcel)]
-            
-    # Select all parcels in the TAZ with households 
-    taz_parcels = taz_parcels[taz_parcels['hh_p']>0][['taz_p', 'hh_p','hh_u', 'parcelid']]
-    # Create records for each household as their constraint
-    if use_capacities:
-        taz_parcels = taz_parcels.loc[taz_parcels.index.repeat(taz_parcels['hh_u'])]
-    else:
-        taz_parcels = taz_parcels.loc[taz_parcels.index.repeat(taz_parcels['hh_p'])]
+    # Weight file row of each parcel
+    rows = table_index.lookup_rows(table_index.build_index(pcl_wgt['parcelid']), parcels['parcelid'])
+    parcels = table_index.join(parcels, pcl_wgt, rows)
+    parcels['weight'] = parcels['weight'].fillna(1)
+    weight = parcels['weight'].to_numpy()
+    parcels['hh_p'] = schema.round_to(parcels['hh_p'].to_numpy() * weight, 'int32')
+    parcels[emp_cols] = schema.round_to(parcels[emp_cols].to_numpy() * weight[:, None], 'int32')
+
+    return parcels
+
+
+def update_parcels(parcels, hh_parcels_df, df_allocate, config, override=None, index=None):
+    """Update parcel households from the allocation and parcel jobs from user_allocation.csv
+
+    index holds the parcel and TAZ indexes of parcels (see base_indexes); they are built if not given.
+    """
+
+    if index is None:
+        index = {'parcel': table_index.build_index(parcels['parcelid']), 'taz': table_index.build_index(parcels['taz_p'])}
+    updated_taz = hh_parcels_df.taz_id.unique()
+
+    #create empty TAZs
+    empty_hh_taz = df_allocate[df_allocate.households ==0].taz_id.unique()
+
+    # Allocated households on each parcel row; parcels of updated TAZs without any get 0
+    new_parcel_df = parcels.copy()
+    rows = table_index.lookup_rows(index['parcel'], hh_parcels_df['parcelid'])
+    new_hh = np.bincount(rows[rows >= 0], minlength=len(new_parcel_df))
+    updated = table_index.key_mask(index['taz'], updated_taz)
+    new_parcel_df['hh_p'] = np.where(updated | (new_hh > 0), new_hh, new_parcel_df['hh_p'].to_numpy())
+    new_parcel_df.loc[table_index.key_mask(index['taz'], empty_hh_taz), 'hh_p'] = 0
+
+    # Update employment
+    if config['update_jobs']:
+        empty_employment_taz = df_allocate[df_allocate.employment == 0].taz_id.unique()
+
+        employment_timings = {}
+        new_parcel_df = allocation.allocate_employment(new_parcel_df, df_allocate, emp_cols, override, employment_timings)
+        allocation.report_timings(employment_timings)
+
+    # Update parcel columns with these new totals
+    new_parcel_df['emptot_p'] = new_parcel_df[emp_cols].sum(axis=1)
+    new_parcel_df[emp_cols] = new_parcel_df[emp_cols].fillna(0)
+
+    # Integerize updated cols and restore their compact dtypes
+    float_cols = [col for col in new_parcel_df.columns.drop(['xcoord_p','ycoord_p'])
+                  if not pd.api.types.is_integer_dtype(new_parcel_df[col])]
+    new_parcel_df[float_cols] = new_parcel_df[float_cols].astype('int64')
+    schema.apply_schema(new_parcel_df, schema.parcel_dtypes)
+
+    #empty employment
+    if config['update_jobs']:
+        new_parcel_df.loc[table_index.key_mask(index['taz'], empty_employment_taz), emp_cols + ['emptot_p']] = 0
+
+    return new_parcel_df, empty_hh_taz
+
+
+def household_attributes(hh_parcels_df, synth_hhs, parcels, max_hhno, rules, index=None):
+    """Translate allocated synthetic households to Soundcast household records
 
-    # Return a random sample from the parcels equal to the original number of households in the taz
-    try:
-        if use_capacities:
-            taz_parcels = taz_parcels.sample(len(taz_df), replace = False, weights = taz_parcels['hh_p'], random_state = 5)
+    index holds the parcel and synthetic household indexes (see base_indexes); they are built if not given.
+    """
+
+    if index is None:
+        index = {'parcel': table_index.build_index(parcels['parcelid']),
+                 'household': table_index.build_index(synth_hhs['household_id'])}
+
+    # See this link for converting to DaySim foramt http://twiki/Data/ParcelizingHouseholds
+    # Join synthetic household data to newly parcelized houeshold data 
+    # Reformat to add as H5 info for household and persons
+    rows = table_index.lookup_rows(index['household'], hh_parcels_df['household_id'])
+    df_hh = table_index.join(hh_parcels_df, synth_hhs, rows)
+
+    df_hh = df_hh.rename(columns={'parcelid': 'hhparcel','taz_p': 'hhtaz', 
+                            'NP': 'hhsize', 'HINCP': 'hhincome'})
+
+    # Set new household ID starting from highest value in existing H5
+    df_hh['hhno'] = range(max_hhno+1, max_hhno+len(df_hh)+1)
+
+    # Own/rent from seed household tenure (hownrent) and housing type from the parcel's share of
+    # single-family versus multifamily units (hrestype), as defined in daysim_recode.csv
+    rows = table_index.lookup_rows(index['parcel'], df_hh['hhparcel'])
+    df_hh = table_index.join(df_hh[rows >= 0], parcels[['sfunits','mfunits']], rows[rows >= 0])
+    df_hh = daysim_recode.recode(df_hh, rules, 'households')
+
+    # Housing type and tenure are unused in Daysim and exported as -1
+    df_hh['hhexpfac'] = 1
+    df_hh[['hrestype','hownrent']] = -1
+
+    return df_hh
+
+
+def person_attributes(synth_persons, df_hh, rules):
+    """Translate synthetic persons to Soundcast person records"""
+
+    # Relate PUMS attributes to Daysim variables
+
+    # columns required: pagey, pgend, pno, pptyp, pwtyp, pstyp
+    empty_fields = ['pdairy','ppaidprk','pspcl','pstaz','ptpass','puwarrp',
+                    'puwdepp','puwmode','pwpcl','pwtaz']
+    new_person_df = synth_persons.copy()
+
+    # Set empty fields to -1 and psexpfac to 1.0
+    new_person_df[empty_fields] = -1
+    new_person_df['psexpfac'] = 1.0
+
+    # These columns can be directly translated
+    new_person_df.rename(columns={'AGEP': 'pagey',    # integer age value
+                                   'SEX': 'pgend',    # gender 1: male, 2: female
+                                   'per_num': 'pno'    # person number within household
+                                   }, inplace=True)
+
+    # Worker type, student type, person type and race, as defined in daysim_recode.csv
+    new_person_df = daysim_recode.recode(new_person_df, rules, 'persons')
+
+    # Get associated household ID
+    rows = table_index.lookup_rows(table_index.build_index(df_hh['household_id']), new_person_df['household_id'])
+    new_person_df = new_person_df.reset_index(drop=True)
+    new_person_df['hhno'] = table_index.take(df_hh['hhno'].to_numpy(), rows)
+
+    return new_person_df
+
+
+def household_persons(person_df, hh_df):
+    """Mask of the persons whose household is in hh_df"""
+
+    return table_index.key_mask(table_index.build_index(person_df['hhno']), hh_df['hhno'])
+
+
+def export_dtypes(myh5):
+    """Dtypes of the columns of a newly written hh_and_persons.h5: every column of the base file as int"""
+
+    return {key: {col: np.dtype('int') for col in myh5[key].keys()} for key in ['Household', 'Person']}
+
+
+def write_h5(df_hh, new_person_df, empty_hh_taz, config, out_h5_path):
+    """Write households and persons to hh_and_persons.h5
+
+    When working with a small study area, only household and person records in study area will be updated.
+    Existing records from hh_persons.h5 from other areas will be unchanged.
+    In cases where we want to update a full region we can turn this off and export all records as a new h5.
+    """
+
+    land_use_path = Path(config['input_land_use_path'])
+    myh5 = h5py.File(land_use_path/'hh_and_persons.h5','r')
+    if config['update_existing_h5'] and config['incremental_h5']:
+        # Copy the base file once and only replace records of the updated and emptied TAZs
+        update_tazs = np.union1d(df_hh['hhtaz'].unique(), empty_hh_taz)
+        export_hh_df = df_hh[~df_hh.hhtaz.isin(empty_hh_taz)]
+        export_person_df = new_person_df[household_persons(new_person_df, export_hh_df)]
+
+        h5_io.prepare_incremental_h5(land_use_path/'hh_and_persons.h5', out_h5_path, update_tazs)
+        out_h5 = h5py.File(out_h5_path, 'a')
+        removed_hhno = h5_io.read_h5_table(out_h5, 'Household', ['hhno'], filter_col='hhtaz', filter_values=update_tazs)['hhno']
+        h5_io.replace_records(out_h5, 'Household', 'hhtaz', update_tazs, export_hh_df)
+        h5_io.replace_records(out_h5, 'Person', 'hhno', removed_hhno, export_person_df)
+        out_h5.attrs['updated_tazs'] = update_tazs.astype('int64')
+        out_h5.close()
+    else:
+        if config['update_existing_h5']:
+            # Existing households outside the updated TAZs, located through an index on hhtaz
+            taz_index = table_index.build_index(myh5['Household']['hhtaz'][:])
+            keep = ~table_index.key_mask(taz_index, df_hh['hhtaz'].unique())
+            export_hh_df = h5_io.read_h5_rows(myh5, 'Household', np.flatnonzero(keep))
+
+            # Select persons of these households through their person row ranges
+            person_index = table_index.build_index(myh5['Person']['hhno'][:])
+            person_rows = np.sort(table_index.group_rows(person_index, export_hh_df['hhno']))
+            export_person_df = h5_io.read_h5_rows(myh5, 'Person', person_rows)
+            export_hh_df = pd.concat([export_hh_df, df_hh[export_hh_df.columns]])
+            export_person_df = pd.concat([export_person_df, new_person_df[export_person_df.columns]])
         else:
-            taz_parcels = taz_parcels.sample(len(taz_df), replace = True, random_state = 5)
-    except:
-        print("Not enough household units in TAZ {}. Please adjust inputs".format(taz))
-        print(taz_parcels[['parcelid','taz_p','hh_p']])
-        sys.exit()
-    # merge HHs and their new parcels
-    taz_parcels.reset_index(inplace=True)
-    taz_df.reset_index(inplace=True)
-    taz_df = taz_df.merge(taz_parcels, how='left', left_index=True, right_index=True)
-    df_list.append(taz_df)
-
-hh_parcels_df = pd.concat(df_list)
-updated_taz = hh_parcels_df.taz_id.unique()
-new_parcel_hhs_total = hh_parcels_df['parcelid'].value_counts()
-
-#create empty TAZs
-empty_hh_taz = df_allocate[df_allocate.households ==0].taz_id.unique()
-
-#############################
-# Update Parcel file
-#############################
-new_parcel_df = parcels.copy()
-df = pd.DataFrame(new_parcel_hhs_total)
-df.columns = ['new_hh']
-df.index.name = 'parcelid'
-new_parcel_df = new_parcel_df.merge(df, left_on='parcelid', right_index=True, how='left')
-# new_parcel_df['hh_p'] = new_parcel_df['new_hh'].fillna(new_parcel_df['hh_p'])
-new_parcel_df.loc[new_parcel_df.taz_p.isin(updated_taz),'hh_p'] = new_parcel_df['new_hh'].fillna(0)
-new_parcel_df.loc[~new_parcel_df.taz_p.isin(updated_taz),'hh_p'] = new_parcel_df['new_hh'].fillna(new_parcel_df['hh_p'])
-new_parcel_df.drop('new_hh', axis=1, inplace=True)
-new_parcel_df.loc[new_parcel_df.taz_p.isin(empty_hh_taz),'hh_p'] = 0
-
-# Update employment
-if config['update_jobs']:
-    df_allocate = pd.read_csv(popsim_run_dir_path/'data'/'user_allocation.csv')
-    empty_employment_taz = df_allocate[df_allocate.employment == 0].taz_id.unique()
-
-    df_allocate = df_allocate[df_allocate['employment'] > 0]
-    emp_cols = ['empedu_p', 'empfoo_p', 'empgov_p', 'empind_p', 'empmed_p','empofc_p', 'empoth_p', 'empret_p', 'emprsc_p', 'empsvc_p']
-    df_list = []
-    for taz in df_allocate['taz_id'].unique():
-        # Select all parcels in the zones
-        df = new_parcel_df[new_parcel_df['taz_p'] == taz]
-        if manual_override:
-            for parcel in override[override.taz_p == taz].parcelid.unique():
-                parcel_override_val = override.loc[override['parcelid'] == parcel].emptot_p.item()
-                if np.isnan(parcel_override_val):
-                    continue
-                df_override = new_parcel_df[new_parcel_df['parcelid'] == parcel]
-                if df_override['emptot_p'].sum() > 0:
-                    new_total = parcel_override_val
-                    emp_factor = (new_total/df_override['emptot_p'].sum()).item()
-                    new_parcel_df.loc[df_override.index, emp_cols] = (df_override[emp_cols]*emp_factor).round()
-                else: 
-                    new_total = parcel_override_val
-                    df_override[emp_cols] = new_parcel_df[emp_cols].sum()
-                    emp_factor = (new_total/df_override['emptot_p'].sum()).item()
-                    new_parcel_df.loc[df_override.index, emp_cols] = (df_override[emp_cols]*emp_factor).round()
-                df = df[~df.parcelid.isin([parcel])]
-                df_allocate.loc[df_allocate['taz_id'] == taz, 'employment'] = df_allocate['employment'] - parcel_override_val
-                
-        if df['emptot_p'].sum() > 0:
-            # For zones with existing distribution, scale jobs based on existing distribution across sectors
-            new_total = df_allocate[df_allocate['taz_id'] == taz]['employment']
-            emp_factor = (new_total/df['emptot_p'].sum()).values[0]
-            new_parcel_df.loc[df.index, emp_cols] = (df[emp_cols]*emp_factor).round()
-# Note: due to rounding the exact totals will not perfectly match the emptot_p specified, but will be close
+            export_hh_df = df_hh.copy()
+            export_person_df = new_person_df.copy()
+
+        #remove households if TAZ is empty
+        export_hh_df = export_hh_df[~export_hh_df.hhtaz.isin(empty_hh_taz)]
+        export_person_df = export_person_df[household_persons(export_person_df, export_hh_df)]
+
+        # Write to h5 file
+        # Delete file if exists
+        if os.path.exists(out_h5_path):
+            os.remove(out_h5_path)
+
+        out_h5 = h5py.File(out_h5_path,'w')
+        for key in ['Person','Household']:
+            out_h5.create_group(key)
+        dtypes = export_dtypes(myh5)
+        for col, dtype in dtypes['Person'].items():
+            out_h5['Person'][col] = export_person_df[col].astype(dtype).values
+        for col, dtype in dtypes['Household'].items():
+            out_h5['Household'][col] = export_hh_df[col].astype(dtype).values
+
+        out_h5.close()
+    myh5.close()
+
+
+def stream_h5(hh_parcels_df, base, parcels, empty_hh_taz, config, out_h5_path, batch_tazs):
+    """Translate and write allocated households and persons to a new h5 file in batches of TAZs
+
+    Used for region-wide runs (update_existing_h5 False). Each batch's households and persons are
+    appended to chunked datasets, so only one batch of translated records is held in memory.
+    Household IDs are the same as when translating all households at once.
+    Returns the number of households and persons written.
+    """
+
+    land_use_path = Path(config['input_land_use_path'])
+    with h5py.File(land_use_path/'hh_and_persons.h5', 'r') as myh5:
+        # Same dtypes as write_h5, whether or not the records are streamed
+        dtypes = export_dtypes(myh5)
+
+    # Allocated households are sorted by TAZ; index persons by the row of their allocated household
+    synth_hhs = base['synth_hhs']
+    synth_persons = base['synth_persons']
+    person_hh_row = table_index.lookup_rows(table_index.build_index(hh_parcels_df['household_id']),
+                                            synth_persons['household_id'])
+    person_index = table_index.build_index(person_hh_row)
+    taz_keys, taz_start, taz_end = allocation.group_offsets(hh_parcels_df['taz_id'].to_numpy())
+
+    if os.path.exists(out_h5_path):
+        os.remove(out_h5_path)
+    num_hhs = num_persons = 0
+    with h5py.File(out_h5_path, 'w') as out_h5:
+        for key in ['Household', 'Person']:
+            h5_io.create_table(out_h5, key, dtypes[key])
+        for b in range(0, len(taz_keys), batch_tazs):
+            start = taz_start[b]
+            end = taz_end[min(b + batch_tazs, len(taz_keys)) - 1]
+            df_hh = household_attributes(hh_parcels_df.iloc[start:end], synth_hhs, parcels, base['max_hhno'] + start,
+                                         base['recode_rules'], base.get('index'))
+            persons = table_index.group_rows(person_index, np.arange(start, end))
+            new_person_df = person_attributes(synth_persons.iloc[persons], df_hh, base['recode_rules'])
+
+            #remove households if TAZ is empty
+            df_hh = df_hh[~df_hh.hhtaz.isin(empty_hh_taz)]
+            new_person_df = new_person_df[household_persons(new_person_df, df_hh)]
+            num_hhs = h5_io.append_records(out_h5, 'Household', df_hh)
+            num_persons = h5_io.append_records(out_h5, 'Person', new_person_df)
+
+    return num_hhs, num_persons
+
+
+def allocate_scenario(base, df_allocate, config, output_dir, override=None, pcl_wgt=None, report=None):
+    """Allocate synthetic households and jobs for one land use scenario and write its outputs
+
+    Returns the number of allocated households and persons and the stage timings.
+    Steps are measured in report if profiling is on.
+    """
+
+    parcels = base['parcels']
+    if pcl_wgt is not None:
+        parcels = apply_parcel_weights(parcels, pcl_wgt)
+
+    # Households from the newly generated synthetic household file are allocated to parcels
+    # based on existing household distributions with TAZs. Parcels with more households are more likely
+    # to recieve new households (within a TAZ).
+    allocation_timings = {}
+    with profiling.profile_stage(report, 'allocate_households', len(base['synth_hhs'])) as entry:
+        if config.get('allocation_processes'):
+            hh_parcels_df = allocation.allocate_households_parallel(base['synth_hhs'], parcels, config['random_seed'],
+                                                                    config['allocation_processes'], config['use_capacities'],
+                                                                    override, allocation_timings)
+        else:
+            rng = np.random.default_rng(config['random_seed'])
+            hh_parcels_df = allocation.allocate_households(base['synth_hhs'], parcels, rng, config['use_capacities'],
+                                                           override, allocation_timings)
+        entry['rows_out'] = len(hh_parcels_df)
+    allocation.report_timings(allocation_timings)
+
+    #############################
+    # Update Parcel file
+    #############################
+    with profiling.profile_stage(report, 'update_parcels', len(parcels)) as entry:
+        new_parcel_df, empty_hh_taz = update_parcels(parcels, hh_parcels_df, df_allocate, config, override,
+                                                     base.get('index'))
+        entry['rows_out'] = len(new_parcel_df)
+    with profiling.profile_stage(report, 'write_parcels', len(new_parcel_df)) as entry:
+        parcel_export.export_parcels(new_parcel_df, base['parcels'], output_dir, config)
+        entry['rows_out'] = len(new_parcel_df)
+
+    if not config['update_existing_h5'] and config['stream_batch_tazs']:
+        with profiling.profile_stage(report, 'stream_h5', len(hh_parcels_df)) as entry:
+            num_hhs, num_persons = stream_h5(hh_parcels_df, base, parcels, empty_hh_taz, config,
+                                             Path(output_dir)/'hh_and_persons.h5', config['stream_batch_tazs'])
+            entry['rows_out'] = num_hhs + num_persons
+    else:
+        #############################
+        # Update Household attributes
+        #############################
+        with profiling.profile_stage(report, 'household_attributes', len(hh_parcels_df)) as entry:
+            df_hh = household_attributes(hh_parcels_df, base['synth_hhs'], parcels, base['max_hhno'], base['recode_rules'],
+                                         base.get('index'))
+            entry['rows_out'] = len(df_hh)
+
+        ########################
+        # Update person attributes
+        ########################
+        with profiling.profile_stage(report, 'person_attributes', len(base['synth_persons'])) as entry:
+            new_person_df = person_attributes(base['synth_persons'], df_hh, base['recode_rules'])
+            entry['rows_out'] = len(new_person_df)
+
+        ####################
+        # Write results to H5
+        ####################
+        with profiling.profile_stage(report, 'write_h5', len(df_hh) + len(new_person_df)):
+            write_h5(df_hh, new_person_df, empty_hh_taz, config, Path(output_dir)/'hh_and_persons.h5')
+        num_hhs, num_persons = len(df_hh), len(new_person_df)
+
+    if report is not None:
+        # Draws are vectorized across TAZs, so per-TAZ work is reported as the rows each TAZ handles
+        report['tables']['allocation_taz'] = pd.DataFrame({
+            'households': hh_parcels_df.groupby('taz_id').size(),
+            'parcels': parcels.groupby('taz_p').size().rename_axis('taz_id')}).dropna(subset=['households']).fillna(0).astype('int64').reset_index()
+        report['tables']['allocation_steps'] = pd.DataFrame({'step': list(allocation_timings.keys()),
+                                                             'wall_s': list(allocation_timings.values())})
+
+    return {'households': num_hhs, 'persons': num_persons, 'timings': allocation_timings}
+
+
+def run_stages(config, report=None):
+    """Run controls, PopulationSim and allocation, skipping stages whose inputs are unchanged"""
+
+    popsim_run_dir_path = Path(config['output_dir'])
+    data_dir = popsim_run_dir_path/'data'
+    output_dir = popsim_run_dir_path/'output'
+    manifest = stage_cache.load_manifest(popsim_run_dir_path/'cache'/'stages.json', config['use_stage_cache'])
+    df_allocate = pd.read_csv(data_dir/'user_allocation.csv')
+    # With popsim_in_process, tables passed between stages without reading back their files
+    frames = {}
+    in_process = config.get('popsim_in_process') and (config.get('popsim_num_processes') or 1) <= 1
+    write_outputs = not in_process or config.get('popsim_write_outputs', True)
+
+    def controls():
+        frames['taz_id_control_data'] = update_controls(config, df_allocate, popsim_run_dir_path)
+
+    def populationsim():
+        if in_process:
+            tables = {name: frames[name] for name in ['taz_id_control_data'] if name in frames}
+            frames['synthetic'] = popsim_runner.run_in_process(config, tables, write_outputs)
         else:
-            # For zones without any distribution scale jobs across sectors using regional distributions
-            # Use an even distribution across all parcels
-            new_total = df_allocate[df_allocate['taz_id'] == taz]['employment']
-
-            # Iterate through each parcel and sector and assign jobs as uniformly as possible
-            emp_factor = (new_total/new_parcel_df['emptot_p'].sum()).values[0]
-            # FIXME: iterating is slow, but we should only have to use it sparingly since most controls should already work off existing job distributions
-            for col in emp_cols:
-                new_parcel_df[col].fillna(0, inplace=True)
-                # total jobs by sector
-                jobs_to_assign = (new_total*(new_parcel_df[col].sum()/new_parcel_df['emptot_p'].sum())).round().astype('int').values[0]
-                if len(new_parcel_df.loc[new_parcel_df['taz_p'] == taz]) > 0:
-                    while jobs_to_assign > 0:
-                        if jobs_to_assign <= len(new_parcel_df.loc[new_parcel_df['taz_p'] == taz]):
-                            # Fewer or equal jobs than parcels in zone; assign jobs to the first parcels in the df
-                            new_parcel_df.loc[new_parcel_df[new_parcel_df['taz_p'] == taz][0:jobs_to_assign].index, col] = new_parcel_df[col] + 1
-                            jobs_to_assign = 0
-                        else:
-                            # More jobs than parcels; iterate until all sector jobs are placed
-                            new_parcel_df.loc[new_parcel_df['taz_p'] == taz, col] = new_parcel_df[col] + 1
-                            jobs_to_assign = jobs_to_assign - len(new_parcel_df.loc[new_parcel_df['taz_p'] == taz])
-                else:
-                    print("No parcels in TAZ {}, please check inputs".format(taz))
-                    sys.exit()
-
-# Update parcel columns with these new totals
-new_parcel_df['emptot_p'] = new_parcel_df[emp_cols].sum(axis=1)
-new_parcel_df[emp_cols] = new_parcel_df[emp_cols].fillna(0)
-
-# Integerize all cols
-int_cols = new_parcel_df.columns.drop(['xcoord_p','ycoord_p'])
-new_parcel_df[int_cols] = new_parcel_df[int_cols].astype('int')
-
-#empty employment
-new_parcel_df.loc[new_parcel_df.taz_p.isin(empty_employment_taz),emp_cols + ['emptot_p']] = 0
-
-new_parcel_df.to_csv(popsim_run_dir_path/'output'/'parcels_urbansim.txt', sep=' ', index=False)
-
-#############################
-# Update Household attributes
-#############################
-# See this link for converting to DaySim foramt http://twiki/Data/ParcelizingHouseholds
-# Merge synthetic household data to newly parcelized houeshold data 
-# Reformat to add as H5 info for household and persons
-df_hh = hh_parcels_df.merge(synth_hhs, on='household_id', how='left')
-
-df_hh = df_hh.rename(columns={'parcelid': 'hhparcel','taz_p': 'hhtaz', 
-                        'NP': 'hhsize', 'HINCP': 'hhincome'})
-
-# Set new household ID starting from highest value in existing H5
-df_hh['hhno'] = range(old_h5_hh['hhno'].max()+1, old_h5_hh['hhno'].max()+len(df_hh)+1)
-
-# Own/rent assigned based on seed household tenure data
-hownrent_map = {
-    1: 1,    # owned with mortage -> owned
-    2: 1,    # owned free and clear -> owned
-    3: 2,    # rented
-    4: 3    # occupied without paying rent -> other
-    }
-df_hh['hownrent'] = df_hh['TEN'].map(hownrent_map)
-
-# Housing type assumed based on share of single-family versus multifamily
-# This field is unused in Daysim; this should be improved if this variable is ever used in the models
-df_hh = df_hh.merge(parcels[['parcelid','sfunits','mfunits']], left_on='hhparcel', right_on='parcelid')
-df_hh['hrestype'] = 1    # Default of single family residence
-df_hh.loc[df_hh['mfunits'] > df_hh['sfunits'],'hrestype'] = 3    # condo/apartment
-
-df_hh['hhexpfac'] = 1
-df_hh[['hrestype','hownrent']] = -1
-
-########################
-# Update person attributes
-########################
-
-# Relate PUMS attributes to Daysim variables
-
-# columns required: pagey, pgend, pno, pptyp, pwtyp, pstyp
-empty_fields = ['pdairy','ppaidprk','pspcl','pstaz','ptpass','puwarrp',
-                'puwdepp','puwmode','pwpcl','pwtaz','prace']
-new_person_df = synth_persons.copy()
-
-# Set empty fields to -1 and psexpfac to 1.0
-new_person_df[empty_fields] = -1
-new_person_df['psexpfac'] = 1.0
-
-# These columns can be directly translated
-new_person_df.rename(columns={'AGEP': 'pagey',    # integer age value
-                               'SEX': 'pgend',    # gender 1: male, 2: female
-                               'per_num': 'pno'    # person number within household
-                               }, inplace=True)
-
-# Worker type
-# Get worker type based on usual hours worker per week (WKHP from PUMS)
-# Assume less than 35 as part-time 
-new_person_df.loc[new_person_df['WKHP'] == 0, 'pwtyp'] = 0    # not a worker
-new_person_df.loc[new_person_df['WKHP'] >= 35 ,'pwtyp'] = 1    # full-time worker
-new_person_df.loc[(new_person_df['WKHP'] < 35) & (new_person_df['WKHP'] > 0) ,'pwtyp'] = 2    # part-time worker
-
-# Student type
-new_person_df.loc[new_person_df['SCH'] == 1, 'pstyp'] = 0    # Not a student
-new_person_df.loc[((new_person_df['SCH'] > 1) & (new_person_df['pwtyp'].isin([0,2]))), 'pstyp'] = 1    # student & not a full-time worker -> full-time student
-new_person_df.loc[((new_person_df['SCH'] > 1) & (new_person_df['pwtyp'] == 1)), 'pstyp'] = 2    # student & full-time job -> part-time student
-# If no SCH information, set to 0 (not a student); this occurs for people of pagey 0-2
-new_person_df.loc[new_person_df['SCH'] == 0, 'pstyp'] = 0
-
-# Person type, based on employment, age, school status
-new_person_df.loc[new_person_df['pwtyp'] == 1, 'pptyp'] = 1    # Full time worker
-new_person_df.loc[new_person_df['pwtyp'] == 2, 'pptyp'] = 2    # Part time worker
-new_person_df.loc[(new_person_df['pwtyp'] == 0) & (new_person_df['pagey'] >= 65), 'pptyp'] = 3    # Non working adult age 65+
-new_person_df.loc[(new_person_df['pwtyp'] == 0) & (new_person_df['pagey'] < 65), 'pptyp'] = 4    # Non working adult age<65
-new_person_df.loc[(new_person_df['pstyp'] > 0) & (new_person_df['SCHG'].isin([15,16])), 'pptyp'] = 5    # University student
-new_person_df.loc[(new_person_df['pstyp'] > 0) & 
-                  (new_person_df['SCHG'].isin([11,12,13,14]) &
-                  (new_person_df['pagey'] >= 16)), 'pptyp'] = 6     # High school student age 16+
-new_person_df.loc[(new_person_df['pagey'] >= 5) & (new_person_df['pagey'] < 16), 'pptyp'] = 7     # Child age 5-15
-new_person_df.loc[(new_person_df['pagey'] < 5) & (new_person_df['pagey'] < 16), 'pptyp'] = 8    # Child age 0-4
-
-# Race
-# white_non_hispanic 
-new_person_df.loc[(new_person_df.RAC1P == 1) & (new_person_df.HISP<2), 'prace'] = 1
-# black_non_hispanic
-new_person_df.loc[(new_person_df.RAC1P == 2) & (new_person_df.HISP<2), 'prace'] = 2
-# asian_non_hispanic
-new_person_df.loc[(new_person_df.RAC1P==6) & (new_person_df.HISP<2), 'prace'] = 3
-# other_non_hispanic
-new_person_df.loc[(new_person_df.RAC1P != 1) & (new_person_df.RAC1P != 2) & (new_person_df.RAC1P != 6) & (new_person_df.RAC1P != 9) & (new_person_df.HISP<2), 'prace'] = 4
-# two_or_more_races_non_hispanic
-new_person_df.loc[(new_person_df.RAC1P==9) & (new_person_df.HISP<2), 'prace'] = 5
-# white_hispanic
-new_person_df.loc[(new_person_df.RAC1P == 1) & (new_person_df.HISP>1), 'prace'] = 6
-# non_white_hispanic
-new_person_df.loc[(new_person_df.RAC1P != 1) & (new_person_df.HISP>1), 'prace'] = 7
-
-# Get associated household ID
-new_person_df = new_person_df.merge(df_hh[['household_id','hhno']], on='household_id', how='left')
-
-####################
-# Write results to H5
-####################
-
-# When working with a small study area, only household and person records in study area will be updated
-# Existing records from hh_persons.h5 from other areas will be unchanged
-# In cases where we want to update a full region we can turn this off and export all records as a new h5
-if config['update_existing_h5']:    
-    export_hh_df = old_h5_hh[~old_h5_hh['hhtaz'].isin(df_hh['hhtaz'])]
-    export_hh_df = export_hh_df.append(df_hh[export_hh_df.columns])
-
-    # Select persons from households within the final export list
-    export_person_df = old_h5_person[old_h5_person['hhno'].isin(export_hh_df['hhno'])]
-    export_person_df = export_person_df.append(new_person_df[old_h5_person.columns])
-else:
-    export_hh_df = df_hh.copy()
-    export_person_df = new_person_df.copy()
-
-#remove households if TAZ is empty
-export_hh_df = export_hh_df[~export_hh_df.hhtaz.isin(empty_hh_taz)]
-export_person_df = export_person_df[export_person_df.hhno.isin(export_hh_df.hhno.unique())]
-
-# Write to h5 file
-# Delete file if exists
-if os.path.exists(popsim_run_dir_path/'output'/'hh_and_persons.h5'):
-    os.remove(popsim_run_dir_path/'output'/'hh_and_persons.h5')
-
-out_h5 = h5py.File(popsim_run_dir_path/'output'/'hh_and_persons.h5','w')
-for key in ['Person','Household']:
-    out_h5.create_group(key)
-for col in myh5['Person'].keys():
-    out_h5['Person'][col] = export_person_df[col].astype('int').values
-for col in myh5['Household'].keys():
-    out_h5['Household'][col] = export_hh_df[col].astype('int').values
-
-out_h5.close()
\ No newline at end of file
+            popsim_runner.run_populationsim(config)
+
+    override_path = None
+    if config['allocation_override'] is not None:
+        override_path = popsim_run_dir_path/'..'/config['allocation_override']
+    weights_path = None
+    if config['parcel_weights'] is not None:
+        weights_path = popsim_run_dir_path/'..'/config['parcel_weights']
+
+    # Check every zone before running anything, so infeasible inputs are found before PopulationSim
+    with profiling.profile_stage(report, 'preflight', len(df_allocate)) as entry:
+        frames['parcels'] = read_parcels(config)
+        override = None
+        if override_path is not None:
+            override = read_override(override_path, frames['parcels'])
+        crosswalk = None
+        if not config['allocation_only']:
+            crosswalk = pd.read_csv(data_dir/'geo_cross_walk.csv')
+        violations = preflight.check_inputs(df_allocate, frames['parcels'], crosswalk, override,
+                                            config['use_capacities'], config['update_jobs'])
+        preflight.report_violations(violations, popsim_run_dir_path/'preflight_violations.csv')
+        entry['rows_out'] = len(violations)
+
+    if not config['allocation_only']:
+        # Update controls from allocation file before running popsim:
+        if config['update_hh'] or config['update_persons']:
+            with profiling.profile_stage(report, 'controls', len(df_allocate)) as entry:
+                entry['skipped'] = not stage_cache.run_stage(
+                    manifest, 'controls', controls,
+                    inputs=[data_dir/'user_allocation.csv', 'control_bins.csv'],
+                    settings={key: config[key] for key in ['update_hh', 'update_persons', 'average_hh_size',
+                                                           'household_cols', 'person_cols']},
+                    outputs=[data_dir/'future_controls.csv'])
+
+        # Run populationsim with controls for study area
+        with profiling.profile_stage(report, 'populationsim') as entry:
+            # Without the synthetic population files there is nothing to check a cached run against
+            entry['skipped'] = not stage_cache.run_stage(
+                manifest if write_outputs else None, 'populationsim', populationsim,
+                inputs=[popsim_run_dir_path/'configs'/'settings.yaml', popsim_run_dir_path/'configs'/'controls.csv'] +
+                       [data_dir/f for f in ['future_controls.csv', 'geo_cross_walk.csv', 'seed_households.csv', 'seed_persons.csv']],
+                settings={key: config.get(key) for key in ['popsim_num_processes', 'popsim_in_process']},
+                outputs=[output_dir/'synthetic_households.csv', output_dir/'synthetic_persons.csv'])
+
+    def allocate():
+        with profiling.profile_stage(report, 'load_base_data') as entry:
+            base = load_base_data(config, frames.get('synthetic'), frames['parcels'])
+            entry['rows_out'] = len(base['parcels']) + len(base['synth_hhs']) + len(base['synth_persons'])
+        override = None
+        if override_path is not None:
+            override = read_override(override_path, base['parcels'], base['index'])
+        pcl_wgt = None
+        if weights_path is not None:
+            pcl_wgt = pd.read_csv(weights_path)
+        allocate_scenario(base, df_allocate, config, output_dir, override, pcl_wgt, report)
+
+    land_use_path = Path(config['input_land_use_path'])
+    with profiling.profile_stage(report, 'allocation', len(df_allocate)) as entry:
+        entry['skipped'] = not stage_cache.run_stage(
+            manifest if write_outputs else None, 'allocation', allocate,
+            inputs=[data_dir/'user_allocation.csv', output_dir/'synthetic_households.csv', output_dir/'synthetic_persons.csv',
+                    land_use_path/'parcels_urbansim.txt', land_use_path/'hh_and_persons.h5', 'daysim_recode.csv',
+                    override_path, weights_path],
+            settings={key: config.get(key) for key in ['update_jobs', 'update_existing_h5', 'incremental_h5', 'use_capacities',
+                                                   'random_seed', 'allocation_processes', 'manual_xwalk', 'stream_batch_tazs',
+                                                   'parcel_copy_format', 'parcel_changed_tazs']},
+            outputs=[output_dir/'parcels_urbansim.txt', output_dir/'hh_and_persons.h5'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run PopulationSim and allocate households and jobs for the study area')
+    parser.add_argument('--profile', action='store_true',
+                        help='write per-stage timings, memory and row counts to output_dir/profile')
+    parser.add_argument('--profile_stage', help='with --profile, also write cProfile statistics for this stage')
+    args = parser.parse_args()
+
+    os.chdir(r'C:\Users\hannah.carson\OneDrive - Resource Systems Group, Inc\PierceCounty\psrc_landuse_allocator\Task_landuse_allocator')
+    # Copy user inputs to and set up populationsim directory
+    config = yaml.safe_load(open("config.yaml"))
+    popsim_run_dir_path = Path(config['output_dir'])
+    shutil.copyfile('populationsim_settings.yaml', popsim_run_dir_path/'configs'/'settings.yaml')
+    shutil.copyfile('controls.csv', popsim_run_dir_path/'configs'/'controls.csv')
+
+    report = None
+    if args.profile:
+        report = profiling.new_report(args.profile_stage, popsim_run_dir_path/'profile')
+    run_stages(config, report)
+    if report is not None:
+        profiling.write_report(report)
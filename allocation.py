@@ -0,0 +1,465 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Household-to-parcel and employment allocation engines used by allocate_hh.py
+# All TAZs are allocated in a single pass: parcels and households are sorted by TAZ once
+# and each household draws its parcel from the cumulative weights of its own TAZ.
+# Employment targets are spread over parcels with array operations and integerized
+# with largest remainder so every TAZ matches its requested total exactly.
+# Households can also be allocated TAZ by TAZ across a process pool. Each TAZ then draws from
+# its own random stream, derived from the seed and the TAZ id, so results do not depend on the
+# number of processes or on which TAZs share a process.
+
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+def group_offsets(sorted_keys):
+    """Return unique keys and their start/end row offsets in an array sorted by key"""
+
+    keys = np.unique(sorted_keys)
+    start = np.searchsorted(sorted_keys, keys, side='left')
+    end = np.searchsorted(sorted_keys, keys, side='right')
+
+    return keys, start, end
+
+
+def lookup_groups(keys, values):
+    """Position of each value in the sorted key array, -1 where the value is missing"""
+
+    if len(keys) == 0:
+        return np.full(len(values), -1, dtype='int64')
+    pos = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+
+    return np.where(keys[pos] == values, pos, -1)
+
+
+def largest_remainder(values, group, totals):
+    """Integerize values so that each group sums exactly to its integer total
+
+    Values are floored and the remaining units of each group go to the values with the
+    largest fractional parts; ties are broken by the original row order.
+    """
+
+    result = np.floor(values)
+    remainder = values - result
+    deficit = np.asarray(totals) - np.bincount(group, weights=result, minlength=len(totals))
+    deficit = np.maximum(np.round(deficit), 0)
+
+    order = np.lexsort((-remainder, group))
+    sorted_group = group[order]
+    group_start = np.searchsorted(sorted_group, sorted_group, side='left')
+    rank = np.arange(len(order)) - group_start
+    result[order[rank < deficit[sorted_group]]] += 1
+
+    return result.astype('int64')
+
+
+def report_timings(timings):
+    """Print per-stage wall-clock timings collected by the allocation engine"""
+
+    for stage, seconds in timings.items():
+        print('{:<30}{:>10.3f} s'.format(stage, seconds))
+
+
+def parcel_weights(parcels, tazs, use_capacities):
+    """Sampling weights for parcels in the given TAZs, sorted by TAZ
+
+    Parcels with capacity but no existing households get a small weight when capacities are used,
+    and TAZs without any existing households are given a uniform distribution.
+    """
+
+    pcl = parcels.loc[parcels['taz_p'].isin(tazs), ['parcelid', 'taz_p', 'hh_p', 'hh_u']]
+    pcl = pcl.sort_values('taz_p', kind='mergesort')
+    taz = pcl['taz_p'].to_numpy()
+    weight = pcl['hh_p'].to_numpy(dtype='float64').copy()
+    units = pcl['hh_u'].to_numpy(dtype='int64')
+    if use_capacities:
+        weight[(units > 0) & (weight == 0)] = .0001
+
+    # if no exisiting HHs in TAZ, assign uniform distribution; one hh for each parcel
+    keys, start, end = group_offsets(taz)
+    taz_total = np.add.reduceat(weight, start) if len(start) else np.zeros(0)
+    empty = np.repeat(taz_total == 0, end - start)
+    weight[empty] = 1
+
+    return pcl['parcelid'].to_numpy(), taz, weight, units
+
+
+def draw_with_replacement(cum_weight, base, total, start, end, group, rng):
+    """Draw one parcel row per household from the cumulative weights of its group"""
+
+    target = base[group] + rng.random(len(group)) * total[group]
+    idx = np.searchsorted(cum_weight, target, side='right')
+
+    return np.clip(idx, start[group], end[group] - 1)
+
+
+def capacity_shortfalls(tazs, demand, capacity):
+    """TAZs where the number of households to allocate exceeds the housing unit capacity"""
+
+    df = pd.DataFrame({'taz_id': tazs, 'households': demand, 'hh_u': capacity})
+
+    return df[df['households'] > df['hh_u']]
+
+
+def draw_with_capacity(weight, capacity, start, end, demand, rng):
+    """Household counts per parcel row for a draw without replacement over housing units
+
+    Units are drawn one at a time, each remaining unit carrying the weight of its parcel, as in a
+    weighted sample of unit rows. Each round proposes all outstanding households of every TAZ from
+    weight * units remaining at the start of the round, and each proposal picks one of those units.
+    Only the first proposal of a unit is accepted; this rejects the k-th proposal of a parcel within
+    a round with the probability the parcel's weight fell by its k earlier draws, so accepted draws
+    follow the sequential distribution exactly. Rejected households are proposed again next round.
+    """
+
+    counts = np.zeros(len(weight), dtype='int64')
+    remaining = demand.astype('int64')
+    while remaining.sum() > 0:
+        available = capacity - counts
+        cum_weight = np.cumsum(weight * available)
+        base = np.concatenate([[0.0], cum_weight])[start]
+        total = cum_weight[end - 1] - base
+        group = np.repeat(np.arange(len(start)), remaining)
+        rows = draw_with_replacement(cum_weight, base, total, start, end, group, rng)
+        # Draws are in proposal order within each TAZ, so unique returns the first proposal of each unit
+        unit = np.floor(rng.random(len(rows)) * available[rows]).astype('int64')
+        _, first = np.unique(rows * (available.max() + 1) + unit, return_index=True)
+        accepted = np.bincount(rows[first], minlength=len(weight))
+        counts += accepted
+        remaining -= np.add.reduceat(accepted, start)
+
+    return counts
+
+
+def override_households(override, hh_keys):
+    """Override parcels with households in the given TAZs, sorted by TAZ, with their TAZ group and household count"""
+
+    ovr = override[override['hh_p'].notnull() & override['taz_p'].isin(hh_keys)]
+    ovr = ovr.sort_values('taz_p', kind='mergesort')
+
+    return ovr, lookup_groups(hh_keys, ovr['taz_p'].to_numpy()), ovr['hh_p'].to_numpy().astype('int64')
+
+
+def override_excess(ovr, ovr_group, ovr_hh, available):
+    """Override parcels in TAZs whose override households add up to more than the TAZ households"""
+
+    requested = np.bincount(ovr_group, weights=ovr_hh, minlength=len(available)).astype('int64')
+    over = requested[ovr_group] > available[ovr_group]
+
+    return pd.DataFrame({'parcelid': ovr['parcelid'].to_numpy()[over], 'taz_id': ovr['taz_p'].to_numpy()[over].astype('int64'),
+                         'override_households': ovr_hh[over], 'taz_override_households': requested[ovr_group][over],
+                         'taz_households': available[ovr_group][over]})
+
+
+def check_taz_households(hh_taz, parcels, override, use_capacities):
+    """Report every TAZ whose households cannot be allocated and stop, as allocate_households does
+
+    hh_taz is the sorted TAZ of each household. Run before TAZs are split into shards, which would
+    otherwise each stop at their own first failing TAZ.
+    """
+
+    hh_keys, hh_start, hh_end = group_offsets(hh_taz)
+    available = hh_end - hh_start
+    parcelid, taz, weight, units = parcel_weights(parcels, hh_keys, use_capacities)
+    reserved = np.zeros(len(hh_keys), dtype='int64')
+    if override is not None:
+        ovr, ovr_group, ovr_hh = override_households(override, hh_keys)
+        report = override_excess(ovr, ovr_group, ovr_hh, available)
+        if len(report) > 0:
+            print("Manual overrides exceed total households in the following TAZs. Please adjust inputs")
+            print(report.to_string(index=False))
+            sys.exit()
+        reserved = np.bincount(ovr_group, weights=ovr_hh, minlength=len(hh_keys)).astype('int64')
+        weight[np.isin(parcelid, ovr['parcelid'])] = 0
+
+    keep = weight > 0
+    if use_capacities:
+        keep &= units > 0
+    p_keys, p_start, p_end = group_offsets(taz[keep])
+    group = lookup_groups(p_keys, hh_keys)
+    todo = available - reserved > 0
+    if use_capacities:
+        taz_capacity = np.add.reduceat(units[keep], p_start) if len(p_start) else np.zeros(0, dtype='int64')
+        capacity = np.append(taz_capacity, 0)[group]
+        shortfall = capacity_shortfalls(hh_keys[todo], (available - reserved)[todo], capacity[todo])
+        if len(shortfall) > 0:
+            print("Not enough household units in the following TAZs. Please adjust inputs")
+            print(shortfall.to_string(index=False))
+            sys.exit()
+    missing = hh_keys[todo & (group == -1)]
+    if len(missing) > 0:
+        print("No parcels with households available in TAZ(s) {}. Please adjust inputs".format(list(missing)))
+        sys.exit()
+
+
+def reserve_override_households(override, hh_keys, hh_start, hh_end, hh_parcel, rng):
+    """Assign households to override parcels, drawn without replacement within each TAZ
+
+    All override parcels are handled in one pass: households are shuffled within their TAZ and
+    each override parcel takes the next block of them. If any TAZ has more override households
+    than synthetic households, all such overrides are reported before stopping.
+    """
+
+    ovr, ovr_group, ovr_hh = override_households(override, hh_keys)
+    available = hh_end - hh_start
+    report = override_excess(ovr, ovr_group, ovr_hh, available)
+    if len(report) > 0:
+        print("Manual overrides exceed total households in the following TAZs. Please adjust inputs")
+        print(report.to_string(index=False))
+        sys.exit()
+
+    # Households in random order within each TAZ; rows in hh_parcel are already sorted by TAZ
+    hh_group = np.repeat(np.arange(len(hh_keys)), available)
+    shuffled = np.lexsort((rng.random(len(hh_group)), hh_group))
+
+    # Override parcels take consecutive blocks of shuffled households from the start of their TAZ
+    ovr_start = np.cumsum(ovr_hh) - ovr_hh
+    taz_offset = ovr_start - ovr_start[np.searchsorted(ovr_group, ovr_group)]
+    slot = np.repeat(hh_start[ovr_group] + taz_offset - ovr_start, ovr_hh) + np.arange(ovr_hh.sum())
+    hh_parcel[shuffled[slot]] = np.repeat(ovr['parcelid'].to_numpy(), ovr_hh)
+
+
+def allocate_households(synth_hhs, parcels, rng, use_capacities=False, override=None, timings=None):
+    """Allocate synthetic households to parcels within their TAZ
+
+    Parcels with more existing households are more likely to receive new households.
+    Returns a DataFrame of household_id, taz_id, hh_id, parcelid and taz_p.
+    """
+
+    if timings is None:
+        timings = {}
+    t0 = time.perf_counter()
+
+    # Households sorted by TAZ, keeping their original order within the TAZ
+    hhs = synth_hhs[['taz_id', 'hh_id', 'household_id']].sort_values('taz_id', kind='mergesort')
+    hh_taz = hhs['taz_id'].to_numpy()
+    hh_parcel = np.full(len(hhs), -1, dtype='int64')
+    hh_keys, hh_start, hh_end = group_offsets(hh_taz)
+
+    parcelid, taz, weight, units = parcel_weights(parcels, hh_keys, use_capacities)
+    timings['prepare_parcels'] = time.perf_counter() - t0
+
+    # Manual overrides reserve households for a parcel and remove that parcel from the TAZ pool
+    t0 = time.perf_counter()
+    if override is not None:
+        reserve_override_households(override, hh_keys, hh_start, hh_end, hh_parcel, rng)
+        weight[np.isin(parcelid, override.loc[override['hh_p'].notnull() & override['taz_p'].isin(hh_keys), 'parcelid'])] = 0
+    timings['overrides'] = time.perf_counter() - t0
+
+    # Select all parcels with households
+    t0 = time.perf_counter()
+    keep = weight > 0
+    if use_capacities:
+        keep &= units > 0
+    parcelid, taz, weight, units = parcelid[keep], taz[keep], weight[keep], units[keep]
+    p_keys, p_start, p_end = group_offsets(taz)
+
+    todo = np.flatnonzero(hh_parcel == -1)
+    group = lookup_groups(p_keys, hh_taz[todo])
+    if use_capacities:
+        # Check every TAZ against its housing unit capacity before drawing
+        todo_keys, todo_start, todo_end = group_offsets(hh_taz[todo])
+        todo_group = lookup_groups(p_keys, todo_keys)
+        taz_capacity = np.add.reduceat(units, p_start) if len(p_start) else np.zeros(0, dtype='int64')
+        # TAZs without parcels (group -1) pick up the appended zero capacity
+        capacity = np.append(taz_capacity, 0)[todo_group]
+        shortfall = capacity_shortfalls(todo_keys, todo_end - todo_start, capacity)
+        if len(shortfall) > 0:
+            print("Not enough household units in the following TAZs. Please adjust inputs")
+            print(shortfall.to_string(index=False))
+            sys.exit()
+    missing = np.unique(hh_taz[todo][group == -1])
+    if len(missing) > 0:
+        print("No parcels with households available in TAZ(s) {}. Please adjust inputs".format(list(missing)))
+        sys.exit()
+
+    if use_capacities:
+        # Sample housing units without replacement, weighted by existing households
+        demand = np.bincount(group, minlength=len(p_keys))
+        counts = draw_with_capacity(weight, units, p_start, p_end, demand, rng)
+        # Shuffle the drawn parcels within each TAZ before pairing them with households
+        rows = np.repeat(np.arange(len(parcelid)), counts)
+        rows = rows[np.lexsort((rng.random(len(rows)), taz[rows]))]
+        hh_parcel[todo] = parcelid[rows]
+    else:
+        cum_weight = np.cumsum(weight)
+        base = np.concatenate([[0.0], cum_weight])[p_start]
+        total = cum_weight[p_end - 1] - base
+        rows = draw_with_replacement(cum_weight, base, total, p_start, p_end, group, rng)
+        hh_parcel[todo] = parcelid[rows]
+    timings['draw'] = time.perf_counter() - t0
+
+    hh_parcels_df = hhs.reset_index(drop=True)
+    hh_parcels_df['parcelid'] = hh_parcel
+    hh_parcels_df['taz_p'] = hh_taz
+
+    return hh_parcels_df
+
+
+def taz_rng(seed, taz):
+    """Random generator of a single TAZ, derived from the seed entropy and the TAZ id"""
+
+    return np.random.default_rng(np.random.SeedSequence([int(seed), int(taz)]))
+
+
+def allocate_taz_shard(hhs, parcels, override, seed, use_capacities):
+    """Allocate the households of a group of TAZs, each TAZ with its own random stream"""
+
+    hhs = hhs.sort_values('taz_id', kind='mergesort')
+    hh_keys, hh_start, hh_end = group_offsets(hhs['taz_id'].to_numpy())
+    parcels = parcels.sort_values('taz_p', kind='mergesort')
+    p_keys, p_start, p_end = group_offsets(parcels['taz_p'].to_numpy())
+    p_group = lookup_groups(p_keys, hh_keys)
+
+    results = []
+    for i, taz in enumerate(hh_keys):
+        # TAZs without parcels get an empty parcel table and are reported by allocate_households
+        j = p_group[i]
+        taz_parcels = parcels.iloc[p_start[j]:p_end[j]] if j >= 0 else parcels.iloc[:0]
+        taz_override = None
+        if override is not None:
+            taz_override = override[override['taz_p'] == taz]
+        results.append(allocate_households(hhs.iloc[hh_start[i]:hh_end[i]], taz_parcels, taz_rng(seed, taz),
+                                           use_capacities, taz_override))
+
+    return pd.concat(results, ignore_index=True)
+
+
+def allocate_households_parallel(synth_hhs, parcels, seed, num_processes, use_capacities=False, override=None,
+                                 timings=None, shards_per_process=4):
+    """Allocate synthetic households to parcels with a random stream per TAZ, across a process pool
+
+    TAZs are split into contiguous shards of similar household counts. The result has the same
+    layout as allocate_households and is identical for any num_processes.
+    """
+
+    if timings is None:
+        timings = {}
+    t0 = time.perf_counter()
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    hhs = synth_hhs[['taz_id', 'hh_id', 'household_id']].sort_values('taz_id', kind='mergesort')
+    hh_keys, hh_start, hh_end = group_offsets(hhs['taz_id'].to_numpy())
+    pcl = parcels.loc[parcels['taz_p'].isin(hh_keys), ['parcelid', 'taz_p', 'hh_p', 'hh_u']]
+    if override is not None:
+        override = override[override['taz_p'].isin(hh_keys)]
+    check_taz_households(hhs['taz_id'].to_numpy(), pcl, override, use_capacities)
+
+    # Shard boundaries at TAZ starts closest to equal shares of the households
+    num_shards = min(len(hh_keys), max(num_processes, 1) * shards_per_process)
+    bounds = np.searchsorted(hh_start, np.linspace(0, len(hhs), num_shards + 1)[1:-1])
+    shard_tazs = [tazs for tazs in np.split(hh_keys, np.unique(bounds)) if len(tazs) > 0]
+    shards = [(hhs[hhs['taz_id'].isin(tazs)], pcl[pcl['taz_p'].isin(tazs)],
+               None if override is None else override[override['taz_p'].isin(tazs)], seed, use_capacities)
+              for tazs in shard_tazs]
+    timings['prepare_shards'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    if num_processes <= 1:
+        results = [allocate_taz_shard(*shard) for shard in shards]
+    else:
+        with ProcessPoolExecutor(num_processes) as pool:
+            results = list(pool.map(allocate_taz_shard, *zip(*shards)))
+    timings['draw'] = time.perf_counter() - t0
+
+    # Shards hold consecutive TAZs, so the merged result stays in TAZ order
+    if len(results) == 0:
+        return allocate_households(synth_hhs.iloc[:0], parcels, np.random.default_rng(seed), use_capacities)
+
+    return pd.concat(results, ignore_index=True)
+
+
+def allocate_employment(parcels, df_allocate, emp_cols, override=None, timings=None):
+    """Scale parcel employment in each TAZ to the employment totals in user_allocation.csv
+
+    Zones with existing jobs keep their parcel and sector distribution. Zones without jobs
+    receive regional sector shares spread evenly over their parcels. Sector totals and then
+    parcel values are integerized with largest remainder so each TAZ hits its total exactly.
+    Returns a copy of parcels with updated employment columns.
+    """
+
+    if timings is None:
+        timings = {}
+    t0 = time.perf_counter()
+
+    new_parcels = parcels.copy()
+    jobs = np.array(new_parcels[emp_cols].fillna(0), dtype='float64')
+    regional_share = jobs.sum(axis=0) / jobs.sum()
+
+    target = df_allocate[df_allocate['employment'] > 0].sort_values('taz_id')
+    taz_keys = target['taz_id'].to_numpy()
+    taz_total = target['employment'].to_numpy(dtype='float64').round()
+    row_group = lookup_groups(taz_keys, new_parcels['taz_p'].to_numpy())
+
+    # Override parcels are scaled to their own total and removed from the TAZ pool
+    if override is not None:
+        ovr = override[override['emptot_p'].notnull() & override['taz_p'].isin(taz_keys)]
+        parcel_ids = new_parcels['parcelid'].to_numpy()
+        parcel_order = np.argsort(parcel_ids, kind='stable')
+        rows = parcel_order[lookup_groups(parcel_ids[parcel_order], ovr['parcelid'].to_numpy())]
+        ovr_jobs = ovr['emptot_p'].to_numpy(dtype='float64')
+        existing = jobs[rows].sum(axis=1)
+        share = np.where(existing[:, None] > 0, jobs[rows] / np.where(existing > 0, existing, 1)[:, None], regional_share[None, :])
+        sector_group = np.repeat(np.arange(len(rows)), len(emp_cols))
+        jobs[rows] = largest_remainder((share * ovr_jobs[:, None]).ravel(), sector_group, ovr_jobs).reshape(-1, len(emp_cols))
+
+        ovr_group = row_group[rows]
+        override_total = np.bincount(ovr_group, weights=ovr_jobs, minlength=len(taz_keys))
+        over = override_total > taz_total
+        if over.any():
+            print("Manual overrides exceed the employment total of the following TAZs; the rest of these TAZs gets no jobs")
+            print(pd.DataFrame({'taz_id': taz_keys[over], 'override_employment': override_total[over],
+                                'employment': taz_total[over]}).to_string(index=False))
+        taz_total = np.maximum(taz_total - override_total, 0)
+        row_group[rows] = -1
+    timings['employment_overrides'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    rows = np.flatnonzero(row_group >= 0)
+    group = row_group[rows]
+    n_parcels = np.bincount(group, minlength=len(taz_keys))
+    # TAZs whose total is taken up by override parcels have nothing left to place
+    missing = taz_keys[(n_parcels == 0) & (taz_total > 0)]
+    if len(missing) > 0:
+        print("No parcels in TAZ(s) {}, please check inputs".format(list(missing)))
+        sys.exit()
+
+    # Per-parcel, per-sector targets
+    existing = np.bincount(group, weights=jobs[rows].sum(axis=1), minlength=len(taz_keys))
+    has_jobs = existing[group] > 0
+    factor = np.divide(taz_total, existing, out=np.zeros(len(taz_keys)), where=existing > 0)
+    cell_target = np.where(has_jobs[:, None],
+                           jobs[rows] * factor[group][:, None],
+                           regional_share[None, :] * (taz_total / np.maximum(n_parcels, 1))[group][:, None])
+
+    # Integerize sector totals within each TAZ, then parcel values within each TAZ and sector
+    n_sectors = len(emp_cols)
+    sector_target = np.zeros((len(taz_keys), n_sectors))
+    np.add.at(sector_target, group, cell_target)
+    sector_group = np.repeat(np.arange(len(taz_keys)), n_sectors)
+    sector_total = largest_remainder(sector_target.ravel(), sector_group, taz_total)
+
+    cell_group = (group[:, None] * n_sectors + np.arange(n_sectors)[None, :]).ravel()
+    jobs[rows] = largest_remainder(cell_target.ravel(), cell_group, sector_total).reshape(-1, n_sectors)
+    timings['employment_integerize'] = time.perf_counter() - t0
+
+    new_parcels[emp_cols] = jobs
+
+    return new_parcels
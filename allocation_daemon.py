@@ -0,0 +1,278 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Keep the allocation running while user_allocation.csv and the allocation override are edited
+# Parcels, the synthetic population and the base hh_and_persons.h5 tables are loaded once. The
+# allocation inputs are polled for changes, and each edit is compared row by row with the
+# previous inputs. Households and jobs are then reallocated only for the TAZs whose rows changed.
+# The parcel rows and the h5 records of those TAZs are patched into the outputs.
+# Every TAZ draws from its own random stream (as with allocation_processes in config.yaml), so the
+# patched outputs match a full run of allocate_hh.py on the edited inputs with the same settings.
+# PopulationSim is not rerun: edits to household or person totals keep the current synthetic
+# population until allocate_hh.py is run again.
+
+import os
+import sys
+import time
+import argparse
+import h5py
+import numpy as np
+import pandas as pd
+import yaml
+from pathlib import Path
+import allocate_hh
+import allocation
+import h5_io
+import preflight
+import table_index
+import parcel_export
+
+
+def input_paths(config):
+    """Allocation input files watched for edits"""
+
+    popsim_run_dir_path = Path(config['output_dir'])
+    paths = {'user_allocation': popsim_run_dir_path/'data'/'user_allocation.csv', 'allocation_override': None}
+    if config['allocation_override'] is not None:
+        paths['allocation_override'] = popsim_run_dir_path/'..'/config['allocation_override']
+
+    return paths
+
+
+def file_stamps(paths):
+    """Size and modification time of each watched file"""
+
+    stamps = {}
+    for name, path in paths.items():
+        if path is not None and os.path.exists(path):
+            stat = os.stat(path)
+            stamps[name] = (stat.st_size, stat.st_mtime)
+
+    return stamps
+
+
+def read_inputs(paths, parcels, index=None):
+    """Current user_allocation.csv and allocation override, with the TAZ of each override parcel"""
+
+    df_allocate = pd.read_csv(paths['user_allocation'])
+    override = None
+    if paths['allocation_override'] is not None and os.path.exists(paths['allocation_override']):
+        override = allocate_hh.read_override(paths['allocation_override'], parcels, index)
+
+    return df_allocate, override
+
+
+def changed_tazs(old, new, taz_col):
+    """TAZs of the rows that differ between two versions of an input table"""
+
+    frames = [df for df in [old, new] if df is not None]
+    if len(frames) == 0:
+        return np.zeros(0, dtype='int64')
+    rows = pd.concat(frames, ignore_index=True).drop_duplicates(keep=False)
+
+    return np.unique(rows[taz_col].dropna().to_numpy().astype('int64'))
+
+
+def load_state(config, output_dir):
+    """Load base data and allocate every TAZ, writing the full outputs"""
+
+    base = allocate_hh.load_base_data(config)
+    parcels = base['parcels']
+    if config['parcel_weights'] is not None:
+        parcels = allocate_hh.apply_parcel_weights(parcels, pd.read_csv(Path(config['output_dir'])/'..'/config['parcel_weights']))
+
+    state = {'config': config, 'base': base, 'parcels': parcels, 'output_dir': Path(output_dir),
+             'paths': input_paths(config), 'synth_tazs': np.unique(base['synth_hhs']['taz_id'])}
+    if config['update_existing_h5']:
+        land_use_path = Path(config['input_land_use_path'])
+        with h5py.File(land_use_path/'hh_and_persons.h5', 'r') as myh5:
+            state['base_h5'] = {key: h5_io.read_h5_table(myh5, key) for key in ['Household', 'Person']}
+
+    state['stamps'] = file_stamps(state['paths'])
+    state['df_allocate'], state['override'] = read_inputs(state['paths'], parcels, base['index'])
+    state['hh_parcels_df'] = allocation.allocate_households_parallel(
+        base['synth_hhs'], parcels, config['random_seed'], config.get('allocation_processes') or 1,
+        config['use_capacities'], state['override'])
+    state['new_parcel_df'], _ = allocate_hh.update_parcels(parcels, state['hh_parcels_df'], state['df_allocate'],
+                                                          config, state['override'], base['index'])
+    write_parcels(state)
+
+    # The output h5 is kept chunked and resizable so that TAZs can be replaced in place
+    out_h5_path = state['output_dir']/'hh_and_persons.h5'
+    if os.path.exists(out_h5_path):
+        os.remove(out_h5_path)
+    if config['update_existing_h5']:
+        h5_io.prepare_incremental_h5(Path(config['input_land_use_path'])/'hh_and_persons.h5', out_h5_path, [])
+    else:
+        with h5py.File(out_h5_path, 'w') as out_h5:
+            with h5py.File(Path(config['input_land_use_path'])/'hh_and_persons.h5', 'r') as myh5:
+                for key, dtypes in allocate_hh.export_dtypes(myh5).items():
+                    h5_io.create_table(out_h5, key, dtypes)
+    all_tazs = np.union1d(state['synth_tazs'], state['df_allocate']['taz_id'].to_numpy())
+    patch_h5(state, all_tazs)
+
+    return state
+
+
+def write_parcels(state):
+    """Write the current parcel table"""
+
+    parcel_export.export_parcels(state['new_parcel_df'], state['base']['parcels'], state['output_dir'], state['config'])
+
+
+def patch_parcels(state, tazs, hh_rows):
+    """Recompute the parcel rows of the given TAZs from their allocated households and jobs"""
+
+    config = state['config']
+    df_allocate = state['df_allocate'][state['df_allocate']['taz_id'].isin(tazs)]
+    override = state['override']
+    if override is not None:
+        override = override[override['taz_p'].isin(tazs)]
+    updated, _ = allocate_hh.update_parcels(state['parcels'], state['hh_parcels_df'].iloc[hh_rows], df_allocate,
+                                            config, override, state['base']['index'])
+
+    rows = table_index.key_mask(state['base']['index']['taz'], tazs)
+    new_parcel_df = state['new_parcel_df']
+    for col in new_parcel_df.columns:
+        values = new_parcel_df[col].to_numpy().copy()
+        values[rows] = updated[col].to_numpy()[rows]
+        new_parcel_df[col] = values
+
+
+def patch_h5(state, tazs):
+    """Replace the household and person records of the given TAZs in the output h5"""
+
+    config = state['config']
+    base = state['base']
+    hh_parcels_df = state['hh_parcels_df']
+    empty_hh_taz = state['df_allocate'].loc[state['df_allocate']['households'] == 0, 'taz_id'].unique()
+
+    # Household IDs follow the position in hh_parcels_df, as in a full run
+    hh_rows = np.flatnonzero(hh_parcels_df['taz_id'].isin(tazs).to_numpy())
+    hh_sub = hh_parcels_df.iloc[hh_rows]
+    df_hh = allocate_hh.household_attributes(hh_sub, base['synth_hhs'], state['parcels'], base['max_hhno'],
+                                             base['recode_rules'], base['index'])
+    df_hh['hhno'] = base['max_hhno'] + 1 + hh_rows
+    synth_persons = base['synth_persons']
+    new_person_df = allocate_hh.person_attributes(synth_persons[synth_persons['household_id'].isin(hh_sub['household_id'])],
+                                                  df_hh, base['recode_rules'])
+
+    export_hh_df = df_hh[~df_hh['hhtaz'].isin(empty_hh_taz)]
+    export_person_df = new_person_df[new_person_df['hhno'].isin(export_hh_df['hhno'])]
+    if config['update_existing_h5']:
+        # TAZs without synthetic households keep their base records unless they are emptied
+        base_h5 = state['base_h5']
+        keep_tazs = np.setdiff1d(np.setdiff1d(tazs, state['synth_tazs']), empty_hh_taz)
+        base_hh = base_h5['Household'][base_h5['Household']['hhtaz'].isin(keep_tazs)]
+        base_person = base_h5['Person'][base_h5['Person']['hhno'].isin(base_hh['hhno'])]
+        export_hh_df = pd.concat([base_hh, export_hh_df[base_hh.columns]])
+        export_person_df = pd.concat([base_person, export_person_df[base_person.columns]])
+
+    with h5py.File(state['output_dir']/'hh_and_persons.h5', 'a') as out_h5:
+        removed_hhno = h5_io.read_h5_table(out_h5, 'Household', ['hhno'], filter_col='hhtaz', filter_values=tazs)['hhno']
+        h5_io.replace_records(out_h5, 'Household', 'hhtaz', tazs, export_hh_df)
+        h5_io.replace_records(out_h5, 'Person', 'hhno', removed_hhno, export_person_df)
+
+    return hh_rows
+
+
+def update(state, df_allocate, override):
+    """Reallocate and patch the outputs for the TAZs whose inputs changed
+
+    Returns the updated TAZs.
+    """
+
+    config = state['config']
+    tazs = changed_tazs(state['df_allocate'], df_allocate, 'taz_id')
+    tazs = np.union1d(tazs, changed_tazs(state['override'], override, 'taz_p'))
+    if len(tazs) == 0:
+        return tazs
+
+    violations = preflight.check_inputs(df_allocate[df_allocate['taz_id'].isin(tazs)], state['parcels'], None,
+                                        override, config['use_capacities'], config['update_jobs'])
+    if len(violations) > 0:
+        print(violations.to_string(index=False))
+    if (violations['severity'] == 'error').any():
+        print("Edits not applied. Please adjust inputs")
+        return np.zeros(0, dtype='int64')
+
+    cols = [col for col in ['taz_id', 'households', 'persons'] if col in df_allocate.columns]
+    totals_changed = changed_tazs(state['df_allocate'][cols], df_allocate[cols], 'taz_id')
+    if len(totals_changed) > 0:
+        print("Household or person totals changed in TAZ(s) {}; the current synthetic population is kept "
+              "until allocate_hh.py is run with PopulationSim".format(totals_changed.tolist()))
+
+    synth_hhs = state['base']['synth_hhs']
+    hh_rows = np.flatnonzero(state['hh_parcels_df']['taz_id'].isin(tazs).to_numpy())
+    parcelid = state['hh_parcels_df']['parcelid'].to_numpy().copy()
+    if len(hh_rows) > 0:
+        # Reallocated households come back in the same TAZ order as their rows in hh_parcels_df
+        hh_new = allocation.allocate_households_parallel(
+            synth_hhs[synth_hhs['taz_id'].isin(tazs)], state['parcels'], config['random_seed'],
+            config.get('allocation_processes') or 1, config['use_capacities'], override)
+        parcelid[hh_rows] = hh_new['parcelid'].to_numpy()
+
+    # The state only changes once the allocation has succeeded
+    state['df_allocate'], state['override'] = df_allocate, override
+    state['hh_parcels_df']['parcelid'] = parcelid
+
+    patch_parcels(state, tazs, hh_rows)
+    write_parcels(state)
+    patch_h5(state, tazs)
+
+    return tazs
+
+
+def watch(state, interval):
+    """Poll the allocation inputs and apply each edit until interrupted"""
+
+    print("Watching {} for changes, press Ctrl+C to stop".format(
+        ', '.join(str(path) for path in state['paths'].values() if path is not None)))
+    while True:
+        time.sleep(interval)
+        stamps = file_stamps(state['paths'])
+        if stamps == state['stamps']:
+            continue
+        try:
+            df_allocate, override = read_inputs(state['paths'], state['parcels'], state['base']['index'])
+        except (OSError, ValueError) as e:
+            # The file may be in the middle of being saved; it is read again on the next change
+            print("Could not read allocation inputs: {!r}".format(e))
+            continue
+        state['stamps'] = stamps
+        t0 = time.perf_counter()
+        try:
+            tazs = update(state, df_allocate, override)
+        except SystemExit:
+            print("Edits not applied. Please adjust inputs")
+            continue
+        if len(tazs) > 0:
+            print("Updated {} TAZ(s) in {:.1f} s".format(len(tazs), time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reallocate households and jobs for edited TAZs as the allocation inputs change')
+    parser.add_argument('-c', '--config', default='config.yaml', help='tool configuration file')
+    parser.add_argument('-i', '--interval', type=float, default=1.0, help='seconds between checks for edited inputs')
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    output_dir = Path(config['output_dir'])/'output'
+    t0 = time.perf_counter()
+    state = load_state(config, output_dir)
+    print("Allocated all TAZs in {:.1f} s".format(time.perf_counter() - t0))
+    try:
+        watch(state, args.interval)
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,137 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Run the household and job allocation for many land use scenarios at once.
+# All scenarios share the PopulationSim outputs of the last run and differ only in their
+# user_allocation.csv, allocation_override and parcel_weights files, listed in a scenario file:
+#
+#   scenarios:
+#     - name: alt_a
+#       user_allocation: alt_a/user_allocation.csv
+#     - name: alt_b
+#       user_allocation: alt_b/user_allocation.csv
+#       allocation_override: alt_b/allocation_override.csv
+#       parcel_weights: alt_b/parcel_weights.csv
+#
+# Paths are relative to the scenario file. Parcels, synthetic households and persons are loaded
+# once and shared read-only with the worker processes (copy-on-write where fork is available).
+# Outputs for each scenario are written to <output_dir>/scenarios/<name>.
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing as mp
+import pandas as pd
+import yaml
+from pathlib import Path
+import allocate_hh
+
+# Base tables shared with worker processes
+_base = None
+
+
+def _init_worker(base):
+    global _base
+    _base = base
+
+
+def run_scenario(spec, config, output_root):
+    """Allocate one scenario against the shared base tables and report its throughput"""
+
+    t0 = time.perf_counter()
+    out_dir = Path(output_root)/spec['name']
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    result = {'scenario': spec['name'], 'status': 'ok', 'households': 0, 'persons': 0}
+    try:
+        df_allocate = pd.read_csv(spec['user_allocation'])
+        override = None
+        if spec.get('allocation_override') is not None:
+            override = allocate_hh.read_override(spec['allocation_override'], _base['parcels'], _base['index'])
+        pcl_wgt = None
+        if spec.get('parcel_weights') is not None:
+            pcl_wgt = pd.read_csv(spec['parcel_weights'])
+        summary = allocate_hh.allocate_scenario(_base, df_allocate, config, out_dir, override, pcl_wgt)
+        result['households'] = summary['households']
+        result['persons'] = summary['persons']
+    except (Exception, SystemExit) as e:
+        # Allocation stops with sys.exit on infeasible inputs; record it and keep the batch going
+        print("Scenario {} failed: {!r}".format(spec['name'], e))
+        result['status'] = 'failed'
+    result['seconds'] = time.perf_counter() - t0
+
+    return result
+
+
+def read_scenarios(path):
+    """Load scenario specs, resolving input paths relative to the scenario file"""
+
+    specs = yaml.safe_load(open(path))['scenarios']
+    root = Path(path).parent
+    for spec in specs:
+        for key in ['user_allocation', 'allocation_override', 'parcel_weights']:
+            if spec.get(key) is not None:
+                spec[key] = root/spec[key]
+
+    return specs
+
+
+def run_batch(specs, config, num_processes):
+    """Run all scenarios in a process pool and write a throughput summary"""
+
+    global _base
+    output_root = Path(config['output_dir'])/'scenarios'
+    t0 = time.perf_counter()
+    _base = allocate_hh.load_base_data(config)
+    load_seconds = time.perf_counter() - t0
+    print("Loaded base data in {:.1f} s".format(load_seconds))
+
+    # Pool workers are daemonic and cannot start processes of their own, so per-TAZ allocation
+    # runs its shards serially inside each worker; the results do not depend on the process count
+    if config.get('allocation_processes'):
+        config = dict(config, allocation_processes=1)
+    args = [(spec, config, output_root) for spec in specs]
+    if 'fork' in mp.get_all_start_methods():
+        # Workers inherit the base tables from this process without copying them
+        with mp.get_context('fork').Pool(num_processes) as pool:
+            results = pool.starmap(run_scenario, args)
+    else:
+        with mp.get_context('spawn').Pool(num_processes, initializer=_init_worker, initargs=(_base,)) as pool:
+            results = pool.starmap(run_scenario, args)
+
+    summary = pd.DataFrame(results)
+    if not os.path.exists(output_root):
+        os.makedirs(output_root)
+    summary.to_csv(output_root/'batch_summary.csv', index=False)
+
+    total_seconds = time.perf_counter() - t0
+    print(summary.to_string(index=False))
+    print("{} scenarios in {:.1f} s ({:.1f} s loading base data), {:.0f} households/s".format(
+        len(summary), total_seconds, load_seconds, summary['households'].sum() / total_seconds))
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Allocate households and jobs for multiple land use scenarios')
+    parser.add_argument('scenarios', help='YAML file listing scenario names and input files')
+    parser.add_argument('-c', '--config', default='config.yaml', help='tool configuration file')
+    parser.add_argument('-n', '--num_processes', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    summary = run_batch(read_scenarios(args.scenarios), config, args.num_processes)
+    if (summary['status'] != 'ok').any():
+        sys.exit(1)
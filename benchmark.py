@@ -0,0 +1,244 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Benchmark the control generator and allocator on a synthetic region
+# A random region of the requested number of TAZs is generated with a parcel file, a Soundcast
+# hh_and_persons.h5, user_allocation.csv and PopulationSim-style synthetic households and persons
+# (PopulationSim itself is not run). Each step is then timed on this data and the results are
+# appended to a CSV with a version label, so runs of different code versions can be compared:
+#
+#   python benchmark.py --tazs 100 1000 3700 --label my-change
+#
+# Generated regions are kept under the data directory and reused by later runs with the same
+# scale and seed.
+
+import os
+import argparse
+import subprocess
+import datetime
+import numpy as np
+import pandas as pd
+import h5py
+from pathlib import Path
+import allocation
+import allocate_hh
+import h5_io
+import control_tables
+import daysim_recode
+import profiling
+
+repo_dir = Path(__file__).resolve().parent
+
+person_empty_fields = ['pdairy', 'ppaidprk', 'pspcl', 'pstaz', 'ptpass', 'puwarrp', 'puwdepp', 'puwmode', 'pwpcl', 'pwtaz']
+
+
+def generate_region(data_dir, num_tazs, parcels_per_taz=350, study_share=0.5, seed=0):
+    """Write a synthetic region of num_tazs zones to data_dir
+
+    Base households and persons are drawn for every parcel; the first study_share of the
+    zones form the study area, which gets new totals in user_allocation.csv and matching
+    synthetic households and persons.
+    """
+
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    # Parcels
+    num_parcels = num_tazs * parcels_per_taz
+    parcels = pd.DataFrame({'parcelid': np.arange(1, num_parcels + 1),
+                            'xcoord_p': rng.random(num_parcels) * 1e6,
+                            'ycoord_p': rng.random(num_parcels) * 1e6,
+                            'taz_p': np.sort(rng.integers(1, num_tazs + 1, num_parcels))})
+    parcels['hh_p'] = rng.poisson(1.3, num_parcels) * (rng.random(num_parcels) < 0.7)
+    parcels['hh_u'] = parcels['hh_p'] + rng.poisson(1.0, num_parcels)
+    parcels['sfunits'] = np.minimum(parcels['hh_p'], 1)
+    parcels['mfunits'] = parcels['hh_p'] - parcels['sfunits']
+    has_jobs = rng.random(num_parcels) < 0.2
+    for col in allocate_hh.emp_cols:
+        parcels[col] = rng.poisson(1.5, num_parcels) * has_jobs
+    parcels['emptot_p'] = parcels[allocate_hh.emp_cols].sum(axis=1)
+    parcels.to_csv(data_dir/'parcels_urbansim.txt', sep=' ', index=False)
+
+    # Base Soundcast households and persons
+    num_hhs = int(parcels['hh_p'].sum())
+    hhs = pd.DataFrame({'hhno': np.arange(1, num_hhs + 1),
+                        'hhparcel': np.repeat(parcels['parcelid'].to_numpy(), parcels['hh_p'].to_numpy())})
+    hhs['hhtaz'] = parcels['taz_p'].to_numpy()[hhs['hhparcel'].to_numpy() - 1]
+    hhs['hhsize'] = rng.integers(1, 7, num_hhs)
+    hhs['hhincome'] = rng.integers(0, 250000, num_hhs)
+    hhs['hownrent'] = -1
+    hhs['hrestype'] = -1
+    hhs['hhexpfac'] = 1
+    num_persons = int(hhs['hhsize'].sum())
+    persons = pd.DataFrame({'hhno': np.repeat(hhs['hhno'].to_numpy(), hhs['hhsize'].to_numpy())})
+    persons['pno'] = persons.groupby('hhno').cumcount() + 1
+    persons['pagey'] = rng.integers(0, 95, num_persons)
+    persons['pgend'] = rng.integers(1, 3, num_persons)
+    persons['pwtyp'] = rng.integers(0, 3, num_persons)
+    persons['pstyp'] = rng.integers(0, 3, num_persons)
+    persons['pptyp'] = rng.integers(1, 9, num_persons)
+    persons['prace'] = rng.integers(1, 8, num_persons)
+    persons[person_empty_fields] = -1
+    persons['psexpfac'] = 1
+    with h5py.File(data_dir/'hh_and_persons.h5', 'w') as h5:
+        for col in hhs.columns:
+            h5['Household/' + col] = hhs[col].to_numpy()
+        for col in persons.columns:
+            h5['Person/' + col] = persons[col].to_numpy()
+
+    # Study area totals, with some zones emptied and some growing
+    study_tazs = np.arange(1, max(int(num_tazs * study_share), 1) + 1)
+    base_hhs = np.bincount(hhs['hhtaz'], minlength=num_tazs + 1)[study_tazs]
+    base_jobs = np.bincount(parcels['taz_p'], weights=parcels['emptot_p'], minlength=num_tazs + 1)[study_tazs]
+    growth = rng.uniform(0.8, 1.3, len(study_tazs)) * (rng.random(len(study_tazs)) > 0.02)
+    df_allocate = pd.DataFrame({'taz_id': study_tazs,
+                                'households': np.round(base_hhs * growth).astype('int64'),
+                                'employment': np.round(base_jobs * growth).astype('int64')})
+    df_allocate['persons'] = np.round(df_allocate['households'] * 2.5).astype('int64')
+    df_allocate.to_csv(data_dir/'user_allocation.csv', index=False)
+
+    # PopulationSim-style synthetic households and persons for the study area
+    num_synth = int(df_allocate['households'].sum())
+    synth_hhs = pd.DataFrame({'household_id': np.arange(1, num_synth + 1),
+                              'taz_id': np.repeat(study_tazs, df_allocate['households'].to_numpy()),
+                              'hh_id': rng.integers(1, 20000, num_synth),
+                              'NP': rng.integers(1, 7, num_synth),
+                              'HINCP': rng.integers(0, 250000, num_synth),
+                              'TEN': rng.integers(1, 5, num_synth),
+                              'WGTP': 10})
+    synth_hhs.to_csv(data_dir/'synthetic_households.csv', index=False)
+    synth_persons = pd.DataFrame({'household_id': np.repeat(synth_hhs['household_id'].to_numpy(), synth_hhs['NP'].to_numpy())})
+    num_synth_persons = len(synth_persons)
+    synth_persons['per_num'] = synth_persons.groupby('household_id').cumcount() + 1
+    synth_persons['AGEP'] = rng.integers(0, 95, num_synth_persons)
+    synth_persons['SEX'] = rng.integers(1, 3, num_synth_persons)
+    synth_persons['WKHP'] = rng.choice([0, 0, 20, 40, 50], num_synth_persons)
+    synth_persons['SCH'] = rng.integers(0, 4, num_synth_persons)
+    synth_persons['SCHG'] = rng.integers(0, 17, num_synth_persons)
+    synth_persons['RAC1P'] = rng.integers(1, 10, num_synth_persons)
+    synth_persons['HISP'] = rng.integers(1, 4, num_synth_persons)
+    synth_persons.to_csv(data_dir/'synthetic_persons.csv', index=False)
+
+
+def region_dir(data_root, num_tazs, seed):
+    """Directory holding the generated region for a scale and seed, generating it if needed"""
+
+    data_dir = Path(data_root)/'tazs_{}_seed_{}'.format(num_tazs, seed)
+    if not os.path.exists(data_dir/'synthetic_persons.csv'):
+        print("Generating region with {} TAZs".format(num_tazs))
+        generate_region(data_dir, num_tazs, seed=seed)
+
+    return data_dir
+
+
+def benchmark_config(data_dir):
+    """Tool settings pointing at a generated region"""
+
+    return {'input_land_use_path': str(data_dir), 'output_dir': str(data_dir), 'manual_xwalk': None,
+            'use_capacities': True, 'random_seed': 5, 'update_jobs': True,
+            'update_existing_h5': True, 'incremental_h5': False}
+
+
+def run_benchmark(data_dir, report):
+    """Time each step of the tool on a generated region"""
+
+    config = benchmark_config(data_dir)
+    df_allocate = pd.read_csv(data_dir/'user_allocation.csv')
+    parcels = allocate_hh.read_parcels(config)
+    synth_hhs = pd.read_csv(data_dir/'synthetic_households.csv')
+    synth_persons = pd.read_csv(data_dir/'synthetic_persons.csv')
+
+    # Control tabulation from the base households and persons
+    with h5py.File(data_dir/'hh_and_persons.h5', 'r') as h5:
+        hhs = h5_io.read_h5_table(h5, 'Household', ['hhno', 'hhtaz', 'hhsize', 'hhincome'])
+        persons = h5_io.read_h5_table(h5, 'Person', ['hhno', 'pwtyp', 'pstyp', 'pgend', 'pagey'])
+    bins = control_tables.read_control_bins(repo_dir/'control_bins.csv')
+    with profiling.profile_stage(report, 'control_tabulation', len(hhs) + len(persons)) as entry:
+        hhs['taz_id'] = hhs['hhtaz']
+        hh_row = control_tables.household_rows(hhs['hhno'], persons['hhno'])
+        persons['taz_id'] = hhs['taz_id'].to_numpy()[hh_row]
+        hhs['hhwkrs'] = np.bincount(hh_row[persons['pwtyp'].to_numpy() > 0], minlength=len(hhs))
+        controls = control_tables.tabulate_controls({'households': hhs, 'persons': persons}, bins)
+        entry['rows_out'] = len(controls)
+
+    # Household allocation, without and with parcel capacities
+    for use_capacities in [False, True]:
+        name = 'allocate_households_capacities' if use_capacities else 'allocate_households'
+        with profiling.profile_stage(report, name, len(synth_hhs)) as entry:
+            hh_parcels_df = allocation.allocate_households(synth_hhs, parcels, np.random.default_rng(5), use_capacities)
+            entry['rows_out'] = len(hh_parcels_df)
+
+    with profiling.profile_stage(report, 'allocate_employment', len(parcels)) as entry:
+        new_parcels = allocation.allocate_employment(parcels, df_allocate, allocate_hh.emp_cols)
+        entry['rows_out'] = len(new_parcels)
+
+    # Translation to Soundcast records and H5 export
+    rules = daysim_recode.read_recode_rules(repo_dir/'daysim_recode.csv')
+    max_hhno = int(hhs['hhno'].max())
+    with profiling.profile_stage(report, 'household_person_attributes', len(hh_parcels_df) + len(synth_persons)) as entry:
+        df_hh = allocate_hh.household_attributes(hh_parcels_df, synth_hhs, parcels, max_hhno, rules)
+        new_person_df = allocate_hh.person_attributes(synth_persons, df_hh, rules)
+        entry['rows_out'] = len(df_hh) + len(new_person_df)
+
+    empty_hh_taz = df_allocate.loc[df_allocate['households'] == 0, 'taz_id'].unique()
+    export_dir = data_dir/'export'
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    with profiling.profile_stage(report, 'h5_export', len(df_hh) + len(new_person_df)):
+        allocate_hh.write_h5(df_hh, new_person_df, empty_hh_taz, config, export_dir/'hh_and_persons.h5')
+
+
+def version_label():
+    """Short git commit of the code being benchmarked, if available"""
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(repo_dir),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the land use allocator on synthetic regions')
+    parser.add_argument('--tazs', type=int, nargs='+', default=[100, 1000], help='region sizes in TAZs')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated regions')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per region; the fastest is kept')
+    parser.add_argument('--data_dir', default='benchmark_data', help='where generated regions are stored')
+    parser.add_argument('--results', default='benchmark_results.csv', help='CSV that results are appended to')
+    parser.add_argument('--label', default=None, help='version label for the results (default: git commit)')
+    args = parser.parse_args()
+
+    label = args.label or version_label()
+    timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+    results = []
+    for num_tazs in args.tazs:
+        data_dir = region_dir(args.data_dir, num_tazs, args.seed)
+        runs = []
+        for i in range(args.repeat):
+            report = profiling.new_report(output_dir=data_dir)
+            run_benchmark(data_dir, report)
+            runs.append(pd.DataFrame(report['stages']))
+        runs = pd.concat(runs)
+        stages = runs['stage'].unique()
+        fastest = runs.sort_values('wall_s').drop_duplicates('stage').set_index('stage').loc[stages].reset_index()
+        fastest.insert(0, 'tazs', num_tazs)
+        results.append(fastest)
+
+    results = pd.concat(results)
+    results.insert(0, 'timestamp', timestamp)
+    results.insert(0, 'label', label)
+    results = results[['label', 'timestamp', 'tazs', 'stage', 'rows_in', 'rows_out', 'wall_s', 'cpu_s', 'peak_rss_mb']]
+    results.to_csv(args.results, mode='a', index=False, header=not os.path.exists(args.results))
+    print(results.to_string(index=False))
@@ -0,0 +1,81 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Zone-level PopulationSim control tabulation used by generate_controls.py
+# Controls are defined in control_bins.csv: each row counts the records of the households or
+# persons table whose column falls in the bin lower < value <= upper, or every record when no
+# column is given. All controls on the same column are counted in one pass: the column is
+# binned once with np.digitize and counted by TAZ code and bin with np.bincount.
+
+import sys
+import numpy as np
+import pandas as pd
+import table_index
+
+
+def read_control_bins(path):
+    """Load control bin definitions, in the column order of the control file"""
+
+    bins = pd.read_csv(path)
+    missing = bins['column'].notnull() & (bins['lower'].isnull() | bins['upper'].isnull())
+    if missing.any():
+        print("Controls {} in {} need both lower and upper bin bounds".format(
+            bins.loc[missing, 'control_field'].tolist(), path))
+        sys.exit(1)
+
+    return bins
+
+
+def household_rows(hhno, person_hhno):
+    """Row of each person's household in the household table, -1 for persons without one"""
+
+    return table_index.lookup_rows(table_index.build_index(hhno), person_hhno)
+
+
+def bin_counts(codes, num_tazs, values, lower, upper):
+    """Counts by TAZ code for bins (lower, upper] of one column, binning the column once"""
+
+    edges = np.unique(np.concatenate([lower, upper]))
+    num_bins = len(edges) + 1
+    bin_idx = np.digitize(values, edges, right=True)
+    counts = np.bincount(codes * num_bins + bin_idx, minlength=num_tazs * num_bins).reshape(num_tazs, num_bins)
+
+    # Bin i holds edges[i-1] < value <= edges[i], so a control spanning edges a to b is cum[b] - cum[a]
+    cum = counts.cumsum(axis=1)
+
+    return cum[:, np.searchsorted(edges, upper)] - cum[:, np.searchsorted(edges, lower)]
+
+
+def tabulate_controls(tables, bins, taz_col='taz_id'):
+    """Control totals by TAZ for the tables named in bins
+
+    tables maps table names to DataFrames with a taz_col column. Returns a DataFrame indexed
+    by taz_col with one column per control, covering every TAZ found in any table.
+    """
+
+    tazs = np.unique(np.concatenate([np.asarray(tables[name][taz_col]) for name in bins['table'].unique()]))
+    result = np.zeros((len(tazs), len(bins)), dtype='int64')
+
+    for name, table_bins in bins.groupby('table', sort=False):
+        codes = np.searchsorted(tazs, np.asarray(tables[name][taz_col]))
+        totals = table_bins['column'].isnull()
+        if totals.any():
+            counts = np.bincount(codes, minlength=len(tazs))
+            result[:, bins.index.get_indexer(table_bins.index[totals])] = counts[:, None]
+        for col, col_bins in table_bins[~totals].groupby('column', sort=False):
+            result[:, bins.index.get_indexer(col_bins.index)] = bin_counts(
+                codes, len(tazs), np.asarray(tables[name][col], dtype='float64'),
+                col_bins['lower'].to_numpy(dtype='float64'), col_bins['upper'].to_numpy(dtype='float64'))
+
+    return pd.DataFrame(result, index=pd.Index(tazs, name=taz_col), columns=bins['control_field'].tolist())
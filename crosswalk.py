@@ -0,0 +1,153 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Spatial crosswalks used by generate_controls.py
+# Parcels are located in study area TAZs and TAZs in PUMAs (by centroid). Results are cached
+# under the output directory, keyed on fingerprints of the GIS inputs and the parcel file,
+# so repeated scenario setups skip reading the GIS layers and the geometry work entirely.
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.prepared import prep
+
+
+def path_fingerprint(path):
+    """Size and modification time of a file, or of every file in a directory such as a .gdb"""
+
+    path = str(path)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+
+    return [[os.path.relpath(f, path), os.stat(f).st_size, os.stat(f).st_mtime] for f in files]
+
+
+def layer_paths(gis_path, config):
+    """GIS inputs backing the TAZ and PUMA layers"""
+
+    if str(gis_path)[-4:] == '.gdb':
+        return [gis_path]
+    paths = []
+    for layer in [config['taz_layer'], config['puma_layer']]:
+        paths += [p for p in gis_path.glob(layer + '.*')]
+
+    return paths
+
+
+def read_gis_layers(gis_path, config):
+    """Load the study area TAZ and regional PUMA layers, renaming ID columns to taz_id and PUMA"""
+
+    # 2 layers are required, including regionwide PUMAs.
+    # a layer that covers a specific study area that can be altered is provided
+    # Only households within the study area will be available for allocation
+    if str(gis_path)[-4:] == '.gdb':
+        taz_study_area = gpd.read_file(gis_path, layer=config['taz_layer'])
+        puma_gdf = gpd.read_file(gis_path, layer=config['puma_layer'])
+    else:
+        taz_study_area = gpd.read_file(gis_path/(config['taz_layer'] + '.shp'))
+        puma_gdf = gpd.read_file(gis_path/(config['puma_layer'] + '.shp'))
+    # Program will use taz_id & puma_id going forward
+    taz_study_area.rename(columns={config['taz_id'] : 'taz_id'}, inplace = True)
+    puma_gdf.rename(columns={config['puma_id'] : 'PUMA'}, inplace = True)
+
+    try:
+        taz_study_area = taz_study_area.to_crs({'init':"EPSG:2285"})
+    except:
+        taz_study_area.crs = {'init':"EPSG:2285"}
+
+    return taz_study_area, puma_gdf
+
+
+def intersecting_pairs(geometry, polygons):
+    """Row positions (geometry, polygon) of intersecting pairs from one bulk spatial index query"""
+
+    sindex = polygons.sindex
+    query = getattr(sindex, 'query_bulk', None) or getattr(sindex, 'query', None)
+    if query is not None:
+        return query(geometry, predicate='intersects')
+
+    # The rtree index of older geopandas is queried one box at a time, so instead the bounds of all
+    # geometries are sorted by x once: the candidates of a polygon are the geometries in its x range,
+    # narrowed down by their bounds and then tested against the prepared polygon
+    geometry = list(geometry)
+    bounds = [geom.bounds if geom is not None else () for geom in geometry]
+    # Empty geometries have empty bounds and match nothing
+    bounds = np.array([b if len(b) == 4 else (np.nan,) * 4 for b in bounds], dtype='float64').reshape(-1, 4)
+    order = np.argsort(bounds[:, 0], kind='stable')
+    min_x = bounds[order, 0]
+    reach = np.nanmax(bounds[:, 2] - bounds[:, 0]) if len(bounds) > 0 and not np.isnan(min_x[0]) else 0
+    pairs = []
+    for j, polygon in enumerate(polygons.geometry):
+        if polygon is None or polygon.is_empty:
+            continue
+        p_min_x, p_min_y, p_max_x, p_max_y = polygon.bounds
+        rows = order[np.searchsorted(min_x, p_min_x - reach, side='left'):np.searchsorted(min_x, p_max_x, side='right')]
+        rows = rows[(bounds[rows, 2] >= p_min_x) & (bounds[rows, 1] <= p_max_y) & (bounds[rows, 3] >= p_min_y)]
+        prepared = prep(polygon)
+        rows = rows[np.array([prepared.intersects(geometry[i]) for i in rows], dtype=bool)]
+        pairs.append(np.vstack([rows, np.full(len(rows), j)]))
+    if len(pairs) == 0:
+        return np.zeros((2, 0), dtype='int64')
+    pairs = np.hstack(pairs).astype('int64')
+
+    return pairs[:, np.lexsort((pairs[1], pairs[0]))]
+
+
+def build_crosswalks(parcels, taz_study_area, puma_gdf, parcel_id):
+    """Parcel to TAZ and TAZ to PUMA crosswalks
+
+    Parcels are placed in TAZs by their coordinates and TAZs in PUMAs by their centroid.
+    """
+
+    points = gpd.points_from_xy(parcels['xcoord_p'], parcels['ycoord_p'])
+    pcl_row, taz_row = intersecting_pairs(points, taz_study_area)
+    taz_cols = [col for col in ['taz_id', 'PUMA'] if col in taz_study_area.columns]
+    parcel_taz = taz_study_area[taz_cols].iloc[taz_row].reset_index(drop=True)
+    parcel_taz.insert(0, parcel_id, parcels[parcel_id].to_numpy()[pcl_row])
+
+    # Identify PUMA for a TAZ based on centroid location
+    centroids = taz_study_area.geometry.centroid.values
+    taz_row, puma_row = intersecting_pairs(centroids, puma_gdf)
+    taz_puma = pd.DataFrame({'taz_id': taz_study_area['taz_id'].to_numpy()[taz_row],
+                             'PUMA': puma_gdf['PUMA'].to_numpy()[puma_row]})
+
+    return parcel_taz, taz_puma
+
+
+def load_crosswalks(parcels, parcel_path, gis_path, config, cache_dir):
+    """Parcel to TAZ and TAZ to PUMA crosswalks, reused from cache_dir when inputs are unchanged"""
+
+    settings = [config[key] for key in ['taz_layer', 'puma_layer', 'taz_id', 'puma_id', 'parcel_id']]
+    key = json.dumps([settings, path_fingerprint(parcel_path)] +
+                     [path_fingerprint(p) for p in layer_paths(gis_path, config)])
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    parcel_taz_path = os.path.join(str(cache_dir), 'parcel_taz_{}.csv'.format(key))
+    taz_puma_path = os.path.join(str(cache_dir), 'taz_puma_{}.csv'.format(key))
+
+    if os.path.exists(parcel_taz_path) and os.path.exists(taz_puma_path):
+        return pd.read_csv(parcel_taz_path), pd.read_csv(taz_puma_path)
+
+    taz_study_area, puma_gdf = read_gis_layers(gis_path, config)
+    parcel_taz, taz_puma = build_crosswalks(parcels, taz_study_area, puma_gdf, config['parcel_id'])
+    if not os.path.exists(str(cache_dir)):
+        os.makedirs(str(cache_dir))
+    parcel_taz.to_csv(parcel_taz_path, index=False)
+    taz_puma.to_csv(taz_puma_path, index=False)
+
+    return parcel_taz, taz_puma
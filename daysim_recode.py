@@ -0,0 +1,112 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Translation of PUMS attributes to Daysim household and person variables
+# Rules are listed in daysim_recode.csv as (table, column, value, expression) rows. For each output
+# column the rules are applied in file order and later matches override earlier ones; a rule with
+# no expression sets the default, which is otherwise -1. Expressions are elementwise numpy
+# expressions over input columns and previously recoded columns.
+#
+# Each output column is evaluated once: the rules are run with np.select over the distinct
+# combinations of the columns they reference, and the result is read back for every record through
+# a lookup array. Adding rules does not add passes over the full table.
+
+import numpy as np
+import pandas as pd
+
+
+def read_recode_rules(path):
+    """Load recoding rules, keeping their order"""
+
+    rules = pd.read_csv(path)
+    rules['expression'] = rules['expression'].fillna('')
+
+    return rules
+
+
+def rule_inputs(rules, available):
+    """Names of available columns referenced by the rule expressions"""
+
+    names = []
+    for expression in rules['expression']:
+        if expression:
+            names += [name for name in compile(expression, '<rule>', 'eval').co_names if name in available]
+
+    return list(dict.fromkeys(names))
+
+
+def compact_dtype(values):
+    """Smallest of int8/int16/int32 holding all values"""
+
+    for dtype in ['int8', 'int16']:
+        info = np.iinfo(dtype)
+        if min(values) >= info.min and max(values) <= info.max:
+            return dtype
+
+    return 'int32'
+
+
+def evaluate_rules(rules, namespace, size):
+    """Rule values for arrays in namespace, later rules taking precedence over earlier ones"""
+
+    defaults = rules.loc[rules['expression'] == '', 'value']
+    default = defaults.iloc[-1] if len(defaults) > 0 else -1
+    rules = rules[rules['expression'] != '']
+    conditions = [np.broadcast_to(np.asarray(eval(expression, {'np': np}, namespace), dtype=bool), (size,))
+                  for expression in rules['expression']]
+
+    # np.select takes the first true condition, so the last rule is listed first
+    return np.select(conditions[::-1], rules['value'].to_numpy()[::-1], default)
+
+
+def recode_column(rules, columns, codes):
+    """Values of one output column for all records
+
+    columns maps names to full-length arrays; codes caches (unique values, inverse) per column
+    so that columns shared by several outputs are only factorized once.
+    """
+
+    inputs = rule_inputs(rules, columns)
+    size = len(next(iter(columns.values())))
+    if len(inputs) == 0:
+        return np.full(size, evaluate_rules(rules, {}, 1)[0])
+    for name in inputs:
+        if name not in codes:
+            codes[name] = np.unique(columns[name], return_inverse=True)
+    shape = tuple(len(codes[name][0]) for name in inputs)
+    num_combinations = int(np.prod(shape, dtype='float64'))
+
+    if num_combinations >= size:
+        # Too many distinct combinations for a lookup array to pay off
+        return evaluate_rules(rules, {name: columns[name] for name in inputs}, size)
+
+    grid = np.unravel_index(np.arange(num_combinations), shape)
+    lookup = evaluate_rules(rules, {name: codes[name][0][idx] for name, idx in zip(inputs, grid)}, num_combinations)
+
+    return lookup[np.ravel_multi_index([codes[name][1].reshape(-1) for name in inputs], shape)]
+
+
+def recode(df, rules, table):
+    """Add the Daysim columns defined for table to df, each as a compact integer column"""
+
+    table_rules = rules[rules['table'] == table]
+    columns = {col: df[col].to_numpy() for col in df.columns}
+    codes = {}
+    for col, col_rules in table_rules.groupby('column', sort=False):
+        values = recode_column(col_rules, columns, codes)
+        columns[col] = values
+        codes.pop(col, None)
+        df[col] = values.astype(compact_dtype(list(col_rules['value']) + [-1]))
+
+    return df
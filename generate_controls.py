@@ -22,50 +22,26 @@ from shapely import wkt
 from shapely.geometry import Point
 import h5py
 import yaml
+import argparse
 from pathlib import Path
 import shutil
+import h5_io
+import parcel_io
+import crosswalk
+import control_tables
+import schema
+import seed_io
+import table_index
+import profiling
 
 
 os.chdir(r'C:\Users\hannah.carson\OneDrive - Resource Systems Group, Inc\PierceCounty\psrc_landuse_allocator\Task_landuse_allocator')
 
-def h5_to_data_frame(h5file, integer_cols, table_name):
-    """Load h5 tables as Pandas DataFrame object"""
-    
-    table = h5file[table_name]
-    col_dict = {}
-    #cols = ['hhno', 'hhtaz']
-    for col in table.keys():
-        if col == 'sov_ff_time':
-            pass
-        elif col in integer_cols:
-            my_array = np.asarray(table[col]).astype('int')
-        else:
-            my_array = np.asarray(table[col])
-        col_dict[col] = my_array.astype(float)
-    return(pd.DataFrame(col_dict))
-
-def update_df(target_df, target_index, update_df, update_index, col_name):
-    target_df[col_name] = 0
-    target_df.set_index(target_index, inplace = True)
-    update_df.set_index(update_index, inplace = True)
-    print(col_name)
-    # target_df.to_csv(r'E:\projects\clients\PierceCounty\Tasks\Task_04_Update_Travel_Demand_Models\Task_landuse_allocator\target_df.csv')
-    # update_df.to_csv(r'E:\projects\clients\PierceCounty\Tasks\Task_04_Update_Travel_Demand_Models\Task_landuse_allocator\update_df.csv')
-    target_df.update(update_df)
-    target_df.reset_index(inplace = True)
-    update_df.reset_index(inplace = True)
-
-    return target_df
-
-
-def recode(df, col, new_col, bins, labels, group_by_col):
-    category = pd.cut(df[col],bins=bins,labels=labels)
-    if new_col in df.columns:
-        df = df.drop(columns = [new_col])
-    df.insert(len(bins), new_col, category)
-
-    return pd.crosstab(df[group_by_col], df[new_col]).rename_axis(None, axis=1)
-
+parser = argparse.ArgumentParser(description='Build PopulationSim controls, crosswalk and seed files for the study area')
+parser.add_argument('--profile', action='store_true',
+                    help='write per-stage timings, memory and row counts to output_dir/profile/generate_controls')
+parser.add_argument('--profile_stage', help='with --profile, also write cProfile statistics for this stage')
+args = parser.parse_args()
 
 config = yaml.safe_load(open("config.yaml"))
 
@@ -85,130 +61,93 @@ for folder in ['configs','data','output']:
         shutil.rmtree(popsim_run_dir_path/folder)
     os.makedirs(popsim_run_dir_path/folder)
 
+report = None
+if args.profile:
+    report = profiling.new_report(args.profile_stage, popsim_run_dir_path/'profile'/'generate_controls')
+
+
+# Load parcel data from Soundcast input
+with profiling.profile_stage(report, 'read_parcels') as entry:
+    parcels_df = parcel_io.load_parcels(land_use_path/config['parcel_file'])
+    parcels_df.columns= parcels_df.columns.str.lower()
+    schema.apply_schema(parcels_df, schema.parcel_dtypes)
+    entry['rows_out'] = len(parcels_df)
 
-# Load GIS files
+# Locate parcels in study area TAZs and TAZs in PUMAs from the GIS layers
 # 2 layers are required, including regionwide PUMAs.
 # a layer that covers a specific study area that can be altered is provided
 # Only households within the study area will be available for allocation
-if str(gis_path)[-4:]=='.gdb':
-    taz_study_area = gpd.read_file(gis_path, layer=config['taz_layer'])
-    # Program will use taz_id & puma_id going forward
-    taz_study_area.rename(columns={config['taz_id'] : 'taz_id'}, inplace = True)
-    puma_gdf = gpd.read_file(gis_path, layer=config['puma_layer'])
-    puma_gdf.rename(columns={config['puma_id'] : 'PUMA'}, inplace = True)
-else:
-    taz_study_area = gpd.read_file(gis_path/config['taz_layer']/'.shp')
-    # Program will use taz_id & puma_id going forward
-    taz_study_area.rename(columns={config['taz_id'] : 'taz_id'}, inplace = True)
-    puma_gdf = gpd.read_file(gis_path/config['puma_layer']/'.shp')
-    puma_gdf.rename(columns={config['puma_id'] : 'PUMA'}, inplace = True)
-
-try:
-    taz_study_area = taz_study_area.to_crs({'init':"EPSG:2285"})
-except:
-    taz_study_area.crs = {'init':"EPSG:2285"}
-# Load parcel data from Soundcast input as geoDataframe
-parcels_gdf = pd.read_csv(land_use_path/config['parcel_file'], sep = ' ')
-parcels_gdf.columns= parcels_gdf.columns.str.lower()
-geometry = [Point(xy) for xy in zip(parcels_gdf['xcoord_p'], parcels_gdf['ycoord_p'])]
-parcels_gdf = parcels_gdf.drop(['ycoord_p', 'xcoord_p'], axis=1)
-parcels_gdf = gpd.GeoDataFrame(parcels_gdf, crs="EPSG:2285", geometry=geometry)
-
-# Load synthetic household and person tables from a Soundcast run
-hdf_file = h5py.File(land_use_path/config['synthetic_pop_file'], "r")
-persons = h5_to_data_frame(hdf_file, ['id'], 'Person')
-hh = h5_to_data_frame(hdf_file, ['id'], 'Household')
-
-# Select parcels that are within the study area
-parcels_cols = list(parcels_gdf.columns)
-#parcels_cols.extend([config['taz_id'], config['block_group_id'], config['puma_id']])
-parcels_cols.extend(['taz_id', 'PUMA'])
-parcels_gdf = gpd.sjoin(parcels_gdf, taz_study_area, how='inner')
-parcels_gdf = parcels_gdf[[col for col in parcels_cols if col in parcels_gdf.columns]]
-# print(parcels_gdf.columns)
-# Identify PUMA for a TAZ based on centroid location
-taz_points = taz_study_area.copy()
-taz_points.geometry = taz_points.geometry.centroid
-taz_puma_gdf = gpd.sjoin(taz_points, puma_gdf, how='inner')
-taz_puma_gdf = taz_puma_gdf[['taz_id', 'PUMA']]
-taz_puma_gdf['region'] = 1
-
-# Write PopulationSim geographic crosswalk between TAZs and PUMAs
-#taz_puma_gdf.rename(columns={config['taz_id']:'taz_id', config['puma_id']:'PUMA'}, inplace = True)
-for col in taz_puma_gdf.columns:
-    taz_puma_gdf[col] = taz_puma_gdf[col].astype('int64')
-
-taz_puma_gdf.to_csv(popsim_run_dir_path/'data'/'geo_cross_walk.csv', index=False)
-
-# Build PopulationSim control file from future land use
-# Distribution of household and person characteristics will be applied to any change in totals
-study_area_hhs = hh[hh['hhparcel'].isin(parcels_gdf[config['parcel_id']])]
-# study_area_hhs = study_area_hhs.merge(parcels_gdf[['parcelid',config['taz_id']]], how = 'left',right_on = 'parcelid',left_on = 'hhparcel')
-# study_area_hhs = update_df(study_area_hhs, 'hhparcel', parcels_gdf, config['parcel_id'], 'taz_id')
-study_area_hhs['taz_id'] = study_area_hhs['hhtaz']
-study_area_persons = persons[persons['hhno'].isin(study_area_hhs['hhno'])]
-study_area_persons = update_df(study_area_persons, 'hhno', study_area_hhs, 'hhno', 'taz_id')
-
-# Get household worker distribution from person table
-workers = study_area_persons[study_area_persons['pwtyp']>0]
-hh_workers = workers.groupby('hhno').size().reset_index()
-hh_workers = hh_workers.rename(columns={0:'hhwkrs'})
-study_area_hhs = update_df(study_area_hhs, 'hhno', hh_workers, 'hhno', 'hhwkrs')
-
-# Household categories
-col_list = []
-# total households:
-col_list.append(pd.DataFrame(study_area_hhs.groupby('taz_id').size(), columns = ['hh_taz_weight']))
-# households size:
-col_list.append(recode(study_area_hhs, 'hhsize', 'num_hh', [0, 1, 2, 3, 4, 5, 6, 200], 
-                       ['hh_size_1','hh_size_2', 'hh_size_3', 'hh_size_4', 'hh_size_5', 'hh_size_6', 'hh_size_7_plus'], 'taz_id'))
-# workers:
-col_list.append(recode(study_area_hhs, 'hhwkrs', 'num_workers', [-1, 0, 1, 2, 999], 
-                       ['workers_0','workers_1', 'workers_2', 'workers_3_plus'], 'taz_id'))
-# income 
-col_list.append(recode(study_area_hhs, 'hhincome', 'income_cat', [-1, 15000, 30000, 60000, 100000, 999999999], 
-                       ['income_lt15','income_gt15-lt30', 'income_gt30-lt60', 'income_gt60-lt100', 'income_gt100'], 'taz_id'))
-
-# Person categories
-# Total persons
-col_list.append(pd.DataFrame(study_area_persons.groupby('taz_id').size(), columns = ['pers_taz_weight']))
-# School:
-col_list.append(recode(study_area_persons, 'pstyp', 'school', [-1, 0, 100], ['school_no','school_yes'], 'taz_id'))
-# Gender:
-col_list.append(recode(study_area_persons, 'pgend', 'gender', [0, 1, 100], ['male','female'], 'taz_id'))
-# Age:
-col_list.append(recode(study_area_persons, 'pagey', 'age', [-1, 19, 35, 60, 999], 
-                       ['age_19_and_under', 'age_20_to_35', 'age_35_to_60', 'age_above_60'], 'taz_id'))
-# Worker status
-col_list.append(recode(study_area_persons, 'pwtyp', 'worker', [0, 999], ['is_worker'], 'taz_id'))
-
-# Race
-# col_list.append(recode(study_area_persons, 'prace', 'num_hh', [0, 1, 2, 3, 4, 5, 6, 200], 
-#                         ['white_non_hispanic', 'black_non_hispanic', 'asian_non_hispanic', 'other_non_hispanic', 'two_or_more_races_non_hispanic', 'white_hispanic', 'non_white_hispanic'], 'taz_id'))
-
-df = pd.concat(col_list, axis = 1)
-df.reset_index(inplace = True)
-#df.rename(columns={config['taz_id']:'taz_id'}, inplace = True)
-df['taz_id'] = df['taz_id'].astype('int64')
+# Crosswalks are cached and reused while the GIS and parcel inputs are unchanged
+with profiling.profile_stage(report, 'crosswalk', len(parcels_df)) as entry:
+    parcel_taz, taz_puma_gdf = crosswalk.load_crosswalks(parcels_df, land_use_path/config['parcel_file'], gis_path, config,
+                                                         popsim_run_dir_path/'cache')
+
+    # Select parcels that are within the study area
+    rows = table_index.lookup_rows(table_index.build_index(parcel_taz[config['parcel_id']]), parcels_df[config['parcel_id']])
+    parcels_df = table_index.join(parcels_df.drop(['ycoord_p', 'xcoord_p'], axis=1)[rows >= 0], parcel_taz, rows[rows >= 0])
+
+    taz_puma_gdf['region'] = 1
+
+    # Write PopulationSim geographic crosswalk between TAZs and PUMAs
+    #taz_puma_gdf.rename(columns={config['taz_id']:'taz_id', config['puma_id']:'PUMA'}, inplace = True)
+    for col in taz_puma_gdf.columns:
+        taz_puma_gdf[col] = taz_puma_gdf[col].astype('int64')
+
+    taz_puma_gdf.to_csv(popsim_run_dir_path/'data'/'geo_cross_walk.csv', index=False)
+    entry['rows_out'] = len(parcels_df)
+
+# Load synthetic household and person tables from a Soundcast run, reading only study area records
+with profiling.profile_stage(report, 'read_synthetic_population') as entry:
+    hdf_file = h5py.File(land_use_path/config['synthetic_pop_file'], "r")
+
+    # Build PopulationSim control file from future land use
+    # Distribution of household and person characteristics will be applied to any change in totals
+    # Households on study area parcels through the parcel index, and their persons through the person row ranges of each hhno
+    parcel_index = table_index.build_index(parcels_df[config['parcel_id']])
+    hh_rows = np.flatnonzero(table_index.lookup_rows(parcel_index, hdf_file['Household']['hhparcel'][:]) >= 0)
+    study_area_hhs = h5_io.read_h5_rows(hdf_file, 'Household', hh_rows, ['hhno', 'hhparcel', 'hhtaz', 'hhsize', 'hhincome'])
+    schema.apply_schema(study_area_hhs, schema.household_dtypes)
+    study_area_hhs['taz_id'] = study_area_hhs['hhtaz']
+    person_index = table_index.build_index(hdf_file['Person']['hhno'][:])
+    person_rows = np.sort(table_index.group_rows(person_index, study_area_hhs['hhno']))
+    study_area_persons = h5_io.read_h5_rows(hdf_file, 'Person', person_rows, ['hhno', 'pwtyp', 'pstyp', 'pgend', 'pagey'])
+    schema.apply_schema(study_area_persons, schema.person_dtypes)
+
+    # Attach household TAZ to persons and count household workers from the person table
+    hh_row = control_tables.household_rows(study_area_hhs['hhno'], study_area_persons['hhno'])
+    study_area_persons['taz_id'] = study_area_hhs['taz_id'].to_numpy()[hh_row]
+    study_area_hhs['hhwkrs'] = np.bincount(hh_row[study_area_persons['pwtyp'].to_numpy() > 0], minlength=len(study_area_hhs))
+    entry['rows_out'] = len(study_area_hhs) + len(study_area_persons)
+
+# Household and person controls, binned as defined in control_bins.csv
+with profiling.profile_stage(report, 'tabulate_controls', len(study_area_hhs) + len(study_area_persons)) as entry:
+    control_bins = control_tables.read_control_bins('control_bins.csv')
+    df = control_tables.tabulate_controls({'households': study_area_hhs, 'persons': study_area_persons}, control_bins)
+    df.reset_index(inplace = True)
+    #df.rename(columns={config['taz_id']:'taz_id'}, inplace = True)
+    df['taz_id'] = df['taz_id'].astype('int64')
+    entry['rows_out'] = len(df)
 
 # Define household totals from allocation fil
-allocate_df = df[['taz_id', 'hh_taz_weight','pers_taz_weight']]
-allocate_df.rename(columns={'hh_taz_weight' : 'households', 'pers_taz_weight': 'persons'}, inplace = True)
-allocate_df = allocate_df.merge(parcels_gdf.groupby('taz_id')['emptot_p'].sum().reset_index(), how = 'left', on = 'taz_id')
-allocate_df.rename(columns={'emptot_p' : 'employment'}, inplace = True)
-allocate_df.to_csv(popsim_run_dir_path/'data'/'user_allocation.csv', index = False)
-df.fillna(0, inplace = True)
-
-
-## Enforce integers
-df = df.astype('int')
-df.to_csv(popsim_run_dir_path/'data'/'future_controls.csv', index=False)
+with profiling.profile_stage(report, 'write_controls', len(df)) as entry:
+    allocate_df = df[['taz_id', 'hh_taz_weight','pers_taz_weight']]
+    allocate_df.rename(columns={'hh_taz_weight' : 'households', 'pers_taz_weight': 'persons'}, inplace = True)
+    taz_index = table_index.build_index(parcels_df['taz_id'])
+    taz_jobs = table_index.group_sum(taz_index, parcels_df['emptot_p'].astype('int64'))
+    allocate_df['employment'] = table_index.take(taz_jobs, table_index.key_positions(taz_index, allocate_df['taz_id']))
+    allocate_df.to_csv(popsim_run_dir_path/'data'/'user_allocation.csv', index = False)
+    df.fillna(0, inplace = True)
+
+    ## Enforce integers
+    df = df.astype('int')
+    df.to_csv(popsim_run_dir_path/'data'/'future_controls.csv', index=False)
+    entry['rows_out'] = len(df)
 
 # Create seed hh and person files; include only seed households and persons from PUMAs within the study area
-seed_hh = pd.read_csv(pums_path/config['seed_hh_file'])
-seed_hh = seed_hh[seed_hh['PUMA'].isin(taz_puma_gdf['PUMA'])]
-seed_hh.to_csv(popsim_run_dir_path/'data'/'seed_households.csv', index=False)
+# Seed files are split by PUMA once and the study area extract is cached for later runs
+with profiling.profile_stage(report, 'seed_files') as entry:
+    seed_io.prepare_seed_files(pums_path/config['seed_hh_file'], pums_path/config['seed_person_file'], taz_puma_gdf['PUMA'],
+                               popsim_run_dir_path/'cache', popsim_run_dir_path/'data')
 
-seed_persons = pd.read_csv(pums_path/config['seed_person_file'])
-seed_persons = seed_persons[seed_persons['hhnum'].isin(seed_hh['hhnum'])]
-seed_persons.to_csv(popsim_run_dir_path/'data'/'seed_persons.csv', index=False)
\ No newline at end of file
+if report is not None:
+    profiling.write_report(report)
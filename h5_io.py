@@ -0,0 +1,218 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Shared access to the Soundcast hh_and_persons.h5 file
+# Tables are stored as one dataset per column under the Household and Person groups.
+# Only requested columns are read, with their native dtypes, and row filters are evaluated
+# on the key column first so that only the matching slices of the other columns are read.
+# Output files can also be updated incrementally: the base file is copied once into chunked,
+# resizable datasets and later runs only rewrite the rows of the TAZs they change.
+
+import os
+import numpy as np
+import pandas as pd
+import h5py
+
+
+def filter_slices(mask, max_gap=4096):
+    """Contiguous row spans covering the True values of mask
+
+    Spans separated by fewer than max_gap rows are merged so that scattered matches are
+    read in a few larger slices instead of many small ones.
+    """
+
+    idx = np.flatnonzero(mask)
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > max_gap)
+    starts = idx[np.concatenate([[0], breaks + 1])]
+    stops = idx[np.concatenate([breaks, [len(idx) - 1]])] + 1
+
+    return list(zip(starts, stops))
+
+
+def read_h5_table(h5file, table_name, columns=None, filter_col=None, filter_values=None, invert=False):
+    """Load h5 table columns as a Pandas DataFrame
+
+    If filter_col is given, only rows where filter_col is in filter_values (or not in them
+    when invert is True) are read.
+    """
+
+    table = h5file[table_name]
+    if columns is None:
+        columns = list(table.keys())
+    if filter_col is None:
+        return pd.DataFrame({col: table[col][:] for col in columns}, columns=columns)
+
+    key = table[filter_col][:]
+    mask = np.isin(key, np.asarray(filter_values), invert=invert)
+
+    return read_masked(table, columns, mask, {filter_col: key})
+
+
+def read_h5_rows(h5file, table_name, rows, columns=None):
+    """Load the given rows of h5 table columns as a Pandas DataFrame, in table order"""
+
+    table = h5file[table_name]
+    if columns is None:
+        columns = list(table.keys())
+    mask = np.zeros(len(table[columns[0]]), dtype=bool)
+    mask[rows] = True
+
+    return read_masked(table, columns, mask)
+
+
+def read_masked(table, columns, mask, loaded=None):
+    """Rows of table columns where mask is True; columns already read in full are given in loaded"""
+
+    loaded = loaded or {}
+    spans = filter_slices(mask)
+    data = {}
+    for col in columns:
+        if col in loaded:
+            data[col] = loaded[col][mask]
+        elif spans:
+            data[col] = np.concatenate([table[col][start:stop][mask[start:stop]] for start, stop in spans])
+        else:
+            data[col] = np.empty(0, dtype=table[col].dtype)
+
+    return pd.DataFrame(data, columns=columns)
+
+
+def row_runs(rows):
+    """Start/stop pairs of consecutive values in a sorted array of row numbers"""
+
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1)
+    starts = rows[np.concatenate([[0], breaks + 1])]
+    stops = rows[np.concatenate([breaks, [len(rows) - 1]])] + 1
+
+    return list(zip(starts, stops))
+
+
+def read_rows(dataset, rows):
+    """Read the given sorted rows of a dataset, one slice per run of consecutive rows"""
+
+    if len(rows) == 0:
+        return np.empty(0, dtype=dataset.dtype)
+
+    return np.concatenate([dataset[start:stop] for start, stop in row_runs(rows)])
+
+
+def write_rows(dataset, rows, values):
+    """Write values to the given sorted rows of a dataset, one slice per run of consecutive rows"""
+
+    offset = 0
+    for start, stop in row_runs(rows):
+        dataset[start:stop] = values[offset:offset + stop - start]
+        offset += stop - start
+
+
+def file_fingerprint(path):
+    """Size and modification time of a file, used to detect a changed base file"""
+
+    stat = os.stat(path)
+
+    return '{}-{}'.format(stat.st_size, int(stat.st_mtime))
+
+
+def prepare_incremental_h5(base_path, out_path, update_tazs, chunk_rows=65536):
+    """Make out_path a chunked, resizable copy of base_path unless a reusable copy exists
+
+    An existing output is reused when it was copied from the same base file and every TAZ it
+    updated before is updated again, so no stale records from earlier runs remain.
+    Returns True if the base file was copied.
+    """
+
+    fingerprint = file_fingerprint(base_path)
+    if os.path.exists(out_path):
+        with h5py.File(out_path, 'r') as out_h5:
+            reusable = (out_h5.attrs.get('base_fingerprint') == fingerprint and
+                        np.isin(out_h5.attrs.get('updated_tazs', []), update_tazs).all())
+        if reusable:
+            return False
+        os.remove(out_path)
+
+    with h5py.File(base_path, 'r') as base_h5, h5py.File(out_path, 'w') as out_h5:
+        for table_name in base_h5.keys():
+            group = out_h5.create_group(table_name)
+            for col in base_h5[table_name].keys():
+                ds = base_h5[table_name][col]
+                out = group.create_dataset(col, shape=ds.shape, maxshape=(None,) + ds.shape[1:],
+                                           chunks=(chunk_rows,) + ds.shape[1:], dtype=ds.dtype)
+                for start in range(0, len(ds), chunk_rows):
+                    out[start:start + chunk_rows] = ds[start:start + chunk_rows]
+        out_h5.attrs['base_fingerprint'] = fingerprint
+        out_h5.attrs['updated_tazs'] = np.zeros(0, dtype='int64')
+
+    return True
+
+
+def replace_records(h5file, table_name, key_col, remove_values, new_df):
+    """Replace the rows of an h5 table whose key_col is in remove_values with the rows of new_df
+
+    New records are written into the rows being removed first and any surplus is appended.
+    If fewer records are written than removed, the remaining gaps are closed by moving rows
+    from the end of the table, so the number of rows rewritten follows the size of the change.
+    """
+
+    table = h5file[table_name]
+    key = table[key_col][:]
+    holes = np.flatnonzero(np.isin(key, remove_values))
+    n_old = len(key)
+    n_new = len(new_df)
+    n_fill = min(len(holes), n_new)
+    fill_rows = holes[:n_fill]
+
+    # Leftover holes are filled with rows from the tail of the table that are being kept
+    spare = holes[n_fill:]
+    n_keep = n_old - len(spare)
+    tail = np.arange(n_keep, n_old)
+    move_from = tail[~np.isin(tail, spare)]
+    move_to = spare[spare < n_keep]
+
+    for col in table.keys():
+        ds = table[col]
+        values = new_df[col].to_numpy().astype(ds.dtype)
+        write_rows(ds, fill_rows, values[:n_fill])
+        write_rows(ds, move_to, read_rows(ds, move_from))
+        ds.resize((n_keep + n_new - n_fill,) + ds.shape[1:])
+        ds[n_keep:] = values[n_fill:]
+
+    return n_keep + n_new - n_fill
+
+
+def create_table(h5file, table_name, dtypes, chunk_rows=65536):
+    """Create an empty h5 table of chunked, resizable datasets, one per column in dtypes"""
+
+    group = h5file.create_group(table_name)
+    for col, dtype in dtypes.items():
+        group.create_dataset(col, shape=(0,), maxshape=(None,), chunks=(chunk_rows,), dtype=dtype)
+
+
+def append_records(h5file, table_name, df):
+    """Append the rows of df to an h5 table, cast to the dtypes of its datasets
+
+    Returns the number of rows in the table.
+    """
+
+    table = h5file[table_name]
+    for col in table.keys():
+        ds = table[col]
+        n_old = len(ds)
+        ds.resize((n_old + len(df),))
+        ds[n_old:] = df[col].to_numpy().astype(ds.dtype)
+
+    return len(ds)
@@ -0,0 +1,146 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Writer for the updated Soundcast parcel file (parcels_urbansim.txt)
+# The table is formatted in chunks of rows on a thread pool. Integer columns are turned into
+# decimal digits with array arithmetic and other numeric columns are converted by numpy. The
+# fields of a chunk are laid out in a byte matrix with separators and the padding is dropped.
+# The output is byte for byte the same as DataFrame.to_csv(sep=' ', index=False).
+# The same table can also be written as Feather or Parquet, and the rows of the TAZs that
+# differ from the input parcel file can be written to a separate file for sub-area runs.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import table_index
+
+
+def int_field(values):
+    """Decimal text of an integer column as a (rows, width) byte matrix, right-aligned and zero-padded"""
+
+    values = values.astype('int64')
+    digits = np.abs(values)
+    num_digits = len(str(digits.max())) if len(digits) > 0 else 1
+    width = num_digits + int(len(values) > 0 and values.min() < 0)
+
+    row_digits = np.ones(len(values), dtype='int64')
+    for power in range(1, num_digits):
+        row_digits += digits >= 10 ** power
+    chars = np.zeros((len(values), width), dtype=np.uint8)
+    for power in range(num_digits):
+        chars[:, width - 1 - power] = np.where(power < row_digits, digits // 10 ** power % 10 + ord('0'), 0)
+    negative = np.flatnonzero(values < 0)
+    chars[negative, width - 1 - row_digits[negative]] = ord('-')
+
+    return chars
+
+
+def text_field(values):
+    """Text of a float or boolean column as a (rows, width) byte matrix, left-aligned and zero-padded"""
+
+    text = values.astype('S')
+    if values.dtype.kind == 'f':
+        # Missing values are written as empty fields
+        text[np.isnan(values)] = b''
+
+    return text.view(np.uint8).reshape(len(values), text.dtype.itemsize)
+
+
+def can_format(df):
+    """True if every column can be formatted without pandas (integer, float or boolean)"""
+
+    return all(df[col].dtype.kind in 'iubf' for col in df.columns)
+
+
+def format_chunk(chunk, line_end):
+    """Rows of chunk as space-delimited text"""
+
+    if not can_format(chunk):
+        # to_csv ends lines with os.linesep by default, as line_end
+        return chunk.to_csv(sep=' ', index=False, header=False).encode()
+
+    blocks = []
+    for i, col in enumerate(chunk.columns):
+        values = chunk[col].to_numpy()
+        blocks.append(int_field(values) if values.dtype.kind in 'iu' else text_field(values))
+        sep = line_end if i == len(chunk.columns) - 1 else ' '
+        blocks.append(np.tile(np.frombuffer(sep.encode(), dtype=np.uint8), (len(chunk), 1)))
+    chars = np.hstack(blocks)
+
+    return chars[chars != 0].tobytes()
+
+
+def write_parcel_text(df, path, chunk_rows=100000, num_threads=4):
+    """Write df as a space-delimited parcel file, formatting chunks of rows in parallel"""
+
+    # to_csv ends lines with os.linesep, which the Soundcast file has always been written with
+    line_end = os.linesep
+    chunks = [df.iloc[start:start + chunk_rows] for start in range(0, len(df), chunk_rows)]
+    with open(path, 'wb') as f:
+        f.write((' '.join(map(str, df.columns)) + line_end).encode())
+        with ThreadPoolExecutor(max(num_threads, 1)) as pool:
+            # Chunks come back in order and are written as they finish
+            for text in pool.map(lambda chunk: format_chunk(chunk, line_end), chunks):
+                f.write(text)
+
+
+def write_parcel_copy(df, path, file_format):
+    """Write df as a Feather or Parquet file"""
+
+    table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+    if file_format == 'feather':
+        feather.write_feather(table, path)
+    elif file_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, path)
+    else:
+        raise ValueError("Unknown parcel copy format {}".format(file_format))
+
+
+def changed_taz_rows(new_parcels, base_parcels):
+    """Rows of the TAZs with any parcel value different from the input parcels
+
+    Both tables hold the same parcels in the same order; only their common columns are compared.
+    """
+
+    cols = [col for col in new_parcels.columns if col in base_parcels.columns]
+    changed = np.zeros(len(new_parcels), dtype=bool)
+    for col in cols:
+        new_values = new_parcels[col].to_numpy()
+        base_values = base_parcels[col].to_numpy()
+        differs = new_values != base_values
+        if new_values.dtype.kind == 'f' and base_values.dtype.kind == 'f':
+            differs &= ~(np.isnan(new_values) & np.isnan(base_values))
+        changed |= differs
+    taz = new_parcels['taz_p'].to_numpy()
+
+    return table_index.key_mask(table_index.build_index(taz), np.unique(taz[changed]))
+
+
+def export_parcels(new_parcel_df, base_parcels, output_dir, config):
+    """Write parcels_urbansim.txt and, as set in config, its Feather/Parquet copy and changed-TAZ file"""
+
+    num_threads = config.get('parcel_export_threads') or 1
+    write_parcel_text(new_parcel_df, os.path.join(str(output_dir), 'parcels_urbansim.txt'), num_threads=num_threads)
+
+    file_format = config.get('parcel_copy_format')
+    if file_format:
+        write_parcel_copy(new_parcel_df, os.path.join(str(output_dir), 'parcels_urbansim.' + file_format), file_format)
+
+    if config.get('parcel_changed_tazs'):
+        rows = changed_taz_rows(new_parcel_df, base_parcels)
+        write_parcel_text(new_parcel_df[rows], os.path.join(str(output_dir), 'parcels_urbansim_changed_tazs.txt'),
+                          num_threads=num_threads)
@@ -0,0 +1,99 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Loader for the Soundcast parcel file (parcels_urbansim.txt)
+# The whitespace-delimited text file is parsed once and stored as a Feather file next to the input,
+# with integer columns downcast to compact dtypes. Later runs memory-map the cached copy as long as
+# the source file's size, modification time and content hash still match.
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+
+def file_hash(path, block_size=1 << 24):
+    """SHA-1 hash of a file's contents"""
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def cache_paths(path):
+    """Feather data and JSON metadata paths of the cache for a parcel file"""
+
+    path = str(path)
+
+    return path + '.cache.feather', path + '.cache.json'
+
+
+def read_parcel_text(path):
+    """Parse a whitespace-delimited parcel file, downcasting integer columns"""
+
+    df = pd.read_csv(path, sep=r'\s+')
+    for col in df.columns:
+        if np.issubdtype(df[col].dtype, np.integer):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+
+    return df
+
+
+def cache_is_valid(path, meta):
+    """Check cache metadata against the source file's size, modification time and hash
+
+    The hash is only computed when the size matches but the modification time does not,
+    e.g. after the file was copied or touched without changes.
+    """
+
+    stat = os.stat(path)
+    if meta.get('size') != stat.st_size:
+        return False
+    if meta.get('mtime') == stat.st_mtime:
+        return True
+
+    return meta.get('sha1') == file_hash(path)
+
+
+def load_parcels(path, use_cache=True):
+    """Load a Soundcast parcel file, building or reusing a columnar cache next to it"""
+
+    data_path, meta_path = cache_paths(path)
+    if use_cache and os.path.exists(data_path) and os.path.exists(meta_path):
+        meta = json.load(open(meta_path))
+        if cache_is_valid(path, meta):
+            if meta['mtime'] != os.stat(path).st_mtime:
+                # Same contents under a new modification time; skip rehashing next time
+                meta['mtime'] = os.stat(path).st_mtime
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+            return feather.read_table(data_path, memory_map=True).to_pandas()
+
+    df = read_parcel_text(path)
+    if use_cache:
+        stat = os.stat(path)
+        meta = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': file_hash(path)}
+        try:
+            feather.write_feather(df, data_path, compression='uncompressed')
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        except OSError:
+            print("Unable to write parcel cache next to {}; continuing without cache".format(path))
+
+    return df
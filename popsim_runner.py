@@ -0,0 +1,229 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Launch PopulationSim for the study area, optionally in several processes.
+# All controls are defined at the taz_id level, so the PUMA seed geographies can be balanced
+# independently. In multiprocess mode the PUMAs are split into shards, each shard gets its own
+# working directory with the matching slice of seed, crosswalk and control data, the shards run
+# in parallel and their outputs are merged back into the main output directory.
+# A single process run can also be driven in the current interpreter: the input tables are
+# handed to the pipeline as DataFrames in place of input_pre_processor and the synthetic
+# households and persons are returned as DataFrames, written to the output folder only on request.
+
+import os
+import sys
+import argparse
+import shutil
+import subprocess
+import yaml
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# PopulationSim outputs that are merged from the shards
+merged_outputs = ['synthetic_households.csv', 'synthetic_persons.csv', 'summary_taz_id.csv', 'expanded_household_ids.csv']
+
+
+def assign_shards(crosswalk, controls, num_shards):
+    """Assign PUMAs to shards so that each shard gets a similar number of control households"""
+
+    hh = crosswalk.merge(controls[['taz_id', 'hh_taz_weight']], how='left', on='taz_id')
+    puma_hh = hh.groupby('PUMA')['hh_taz_weight'].sum().sort_values(ascending=False)
+
+    # Largest PUMAs first, each to the least loaded shard
+    load = np.zeros(min(num_shards, len(puma_hh)))
+    shards = [[] for _ in range(len(load))]
+    for puma, households in puma_hh.items():
+        i = load.argmin()
+        shards[i].append(puma)
+        load[i] += households
+
+    return shards
+
+
+def write_shard(popsim_run_dir_path, shard_dir, pumas):
+    """Set up a PopulationSim working directory with the data for a subset of PUMAs"""
+
+    for folder in ['configs', 'data', 'output']:
+        if os.path.exists(shard_dir/folder):
+            shutil.rmtree(shard_dir/folder)
+    shutil.copytree(popsim_run_dir_path/'configs', shard_dir/'configs')
+    os.makedirs(shard_dir/'data')
+    os.makedirs(shard_dir/'output')
+
+    data_dir = popsim_run_dir_path/'data'
+    crosswalk = pd.read_csv(data_dir/'geo_cross_walk.csv')
+    crosswalk = crosswalk[crosswalk['PUMA'].isin(pumas)]
+    crosswalk.to_csv(shard_dir/'data'/'geo_cross_walk.csv', index=False)
+
+    controls = pd.read_csv(data_dir/'future_controls.csv')
+    controls[controls['taz_id'].isin(crosswalk['taz_id'])].to_csv(shard_dir/'data'/'future_controls.csv', index=False)
+
+    seed_hh = pd.read_csv(data_dir/'seed_households.csv')
+    seed_hh = seed_hh[seed_hh['PUMA'].isin(pumas)]
+    seed_hh.to_csv(shard_dir/'data'/'seed_households.csv', index=False)
+
+    seed_persons = pd.read_csv(data_dir/'seed_persons.csv')
+    seed_persons[seed_persons['hhnum'].isin(seed_hh['hhnum'])].to_csv(shard_dir/'data'/'seed_persons.csv', index=False)
+
+
+def merge_shard_outputs(shard_dirs, output_dir):
+    """Concatenate shard outputs, renumbering household_id so it stays unique"""
+
+    # Each shard numbers its households from 1; shift them past the households of earlier shards
+    offsets = [0]
+    for shard_dir in shard_dirs[:-1]:
+        households = pd.read_csv(shard_dir/'output'/'synthetic_households.csv', usecols=['household_id'])
+        offsets.append(offsets[-1] + (households['household_id'].max() if len(households) > 0 else 0))
+
+    for filename in merged_outputs:
+        frames = []
+        for shard_dir, offset in zip(shard_dirs, offsets):
+            if not os.path.exists(shard_dir/'output'/filename):
+                continue
+            df = pd.read_csv(shard_dir/'output'/filename)
+            if 'household_id' in df.columns:
+                df['household_id'] += offset
+            frames.append(df)
+        if len(frames) > 0:
+            pd.concat(frames).to_csv(Path(output_dir)/filename, index=False)
+
+
+def read_input_tables(data_dir, settings, tables=None):
+    """Input tables of the PopulationSim run, reading those not already in tables from data_dir"""
+
+    tables = dict(tables or {})
+    for table_info in settings['input_table_list']:
+        if table_info['tablename'] not in tables:
+            tables[table_info['tablename']] = pd.read_csv(Path(data_dir)/table_info['filename'])
+
+    return tables
+
+
+def merge_seed_data(expanded_household_ids, seed_df, columns, settings, table_name):
+    """Seed columns joined to the expanded households, as PopulationSim's merge_seed_data"""
+
+    hh_col = settings['household_id_col']
+    # Output columns missing from the seed table are dropped with a warning
+    missing = [col for col in columns if col not in seed_df.columns and col != hh_col]
+    if len(missing) > 0:
+        print("Warning: columns {} not in {}, not written to the synthetic population".format(missing, table_name))
+    df_columns = [col for col in columns if col in seed_df.columns and col != settings['seed_geography']]
+
+    right_index = seed_df.index.name == hh_col
+    if not right_index and hh_col not in df_columns:
+        df_columns.append(hh_col)
+    merged = pd.merge(expanded_household_ids, seed_df[df_columns], how='left', left_on=hh_col,
+                      right_index=right_index, right_on=None if right_index else hh_col)
+    if hh_col not in columns:
+        del merged[hh_col]
+
+    return merged
+
+
+def synthetic_population(expanded_household_ids, households, persons, settings):
+    """Synthetic households and persons as written by write_synthetic_population"""
+
+    spec = settings['output_synthetic_population']
+    household_id = spec.get('household_id', 'HH_ID')
+
+    expanded_household_ids = expanded_household_ids.reset_index(drop=True)
+    expanded_household_ids[household_id] = np.arange(1, len(expanded_household_ids) + 1)
+
+    synth_hhs = merge_seed_data(expanded_household_ids, households, spec['households']['columns'], settings, 'households')
+    # PopulationSim writes the household id as the index, in the first column
+    synth_hhs = synth_hhs[[household_id] + [col for col in synth_hhs.columns if col != household_id]]
+    synth_persons = merge_seed_data(expanded_household_ids, persons, spec['persons']['columns'], settings, 'persons')
+
+    return synth_hhs, synth_persons
+
+
+def run_in_process(config, tables=None, write_outputs=True):
+    """Run PopulationSim in this process and return the synthetic households and persons
+
+    tables maps input_table_list table names to DataFrames; other tables are read from the data
+    folder. With write_outputs, the synthetic population and output tables are also written to
+    the output folder as by a standalone run.
+    """
+
+    from activitysim.core import config as asim_config
+    from activitysim.core import inject, pipeline
+    from activitysim.cli.run import add_run_args, handle_standard_args
+    # Registers the PopulationSim steps and run_populationsim.py's injectables
+    import run_populationsim
+
+    popsim_run_dir_path = Path(config['output_dir'])
+    settings = yaml.safe_load(open(popsim_run_dir_path/'configs'/'settings.yaml'))
+    tables = read_input_tables(popsim_run_dir_path/'data', settings, tables)
+
+    @inject.step()
+    def input_tables_from_memory():
+        # Same preparation as input_pre_processor, without reading the data folder
+        for table_info in settings['input_table_list']:
+            df = tables[table_info['tablename']].rename(columns=table_info.get('column_map', {}))
+            if table_info.get('index_col') is not None:
+                df = df.set_index(table_info['index_col'])
+            inject.add_table(table_info['tablename'], df)
+
+    # handle_standard_args changes to the working directory; relative paths used by the
+    # caller after this run resolve from the original one again
+    cwd = os.getcwd()
+    try:
+        parser = argparse.ArgumentParser()
+        add_run_args(parser)
+        handle_standard_args(parser.parse_args(['-w', str(popsim_run_dir_path)]))
+
+        steps = asim_config.setting('models') or asim_config.setting('run_list')['steps']
+        skipped = ['input_pre_processor'] if write_outputs else ['input_pre_processor', 'write_tables', 'write_synthetic_population']
+        steps = ['input_tables_from_memory'] + [step for step in steps if step not in skipped]
+
+        pipeline.run(models=steps)
+        synth_hhs, synth_persons = synthetic_population(pipeline.get_table('expanded_household_ids'),
+                                                        pipeline.get_table('households'),
+                                                        pipeline.get_table('persons'), settings)
+    finally:
+        if pipeline.is_open():
+            pipeline.close_pipeline()
+        os.chdir(cwd)
+
+    return synth_hhs, synth_persons
+
+
+def run_populationsim(config):
+    """Run populationsim with controls for study area"""
+
+    num_processes = config.get('popsim_num_processes') or 1
+    if num_processes <= 1:
+        returncode = subprocess.call([sys.executable, 'run_populationsim.py', '-w', config['output_dir']])
+        if returncode != 0:
+            sys.exit(1)
+        return
+
+    popsim_run_dir_path = Path(config['output_dir'])
+    crosswalk = pd.read_csv(popsim_run_dir_path/'data'/'geo_cross_walk.csv')
+    controls = pd.read_csv(popsim_run_dir_path/'data'/'future_controls.csv')
+    shard_dirs = []
+    for i, pumas in enumerate(assign_shards(crosswalk, controls, num_processes)):
+        shard_dir = popsim_run_dir_path/'shards'/'shard_{}'.format(i)
+        write_shard(popsim_run_dir_path, shard_dir, pumas)
+        shard_dirs.append(shard_dir)
+
+    print("Running PopulationSim in {} processes".format(len(shard_dirs)))
+    procs = [subprocess.Popen([sys.executable, 'run_populationsim.py', '-w', str(shard_dir)]) for shard_dir in shard_dirs]
+    returncodes = [proc.wait() for proc in procs]
+    if any(returncode != 0 for returncode in returncodes):
+        print("PopulationSim failed for shard(s) {}".format([i for i, code in enumerate(returncodes) if code != 0]))
+        sys.exit(1)
+
+    merge_shard_outputs(shard_dirs, popsim_run_dir_path/'output')
@@ -0,0 +1,99 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Pre-flight checks of the allocation inputs, run by allocate_hh.py before PopulationSim
+# Every zone of user_allocation.csv is checked against the parcel table (with manual_xwalk
+# applied), the allocation overrides, the housing unit capacities and the PopulationSim crosswalk
+# in one grouped pass. All violations are written to a single report, and the run stops before
+# PopulationSim when any of them would make the allocation fail.
+
+import sys
+import numpy as np
+import pandas as pd
+import allocation
+
+# Checks that stop the run; others are reported as warnings
+blocking_checks = ['missing_from_crosswalk', 'override_exceeds_households', 'insufficient_capacity',
+                   'no_parcels_for_households', 'no_parcels_for_jobs']
+
+
+def check_inputs(df_allocate, parcels, crosswalk=None, override=None, use_capacities=True, update_jobs=True):
+    """Violations of the zones in df_allocate, one row per zone and check
+
+    value is the zone's requested quantity and limit what the inputs can hold.
+    """
+
+    alloc = df_allocate.sort_values('taz_id', kind='mergesort')
+    keys = alloc['taz_id'].to_numpy()
+    households = alloc['households'].fillna(0).to_numpy(dtype='float64')
+    employment = alloc['employment'].fillna(0).to_numpy(dtype='float64') if 'employment' in alloc.columns else np.zeros(len(keys))
+
+    pcl_group = allocation.lookup_groups(keys, parcels['taz_p'].to_numpy())
+    ovr_hh = np.zeros(len(keys))
+    ovr_emp = np.zeros(len(keys))
+    hh_ovr_parcel = np.zeros(len(parcels), dtype=bool)
+    emp_ovr_parcel = np.zeros(len(parcels), dtype=bool)
+    if override is not None:
+        ovr = override[override['taz_p'].notnull()]
+        ovr_group = allocation.lookup_groups(keys, ovr['taz_p'].to_numpy().astype('int64'))
+        for col, totals, is_ovr in [('hh_p', ovr_hh, hh_ovr_parcel), ('emptot_p', ovr_emp, emp_ovr_parcel)]:
+            if col not in ovr.columns:
+                continue
+            rows = (ovr_group >= 0) & ovr[col].notnull().to_numpy()
+            totals += np.bincount(ovr_group[rows], weights=ovr[col].to_numpy()[rows], minlength=len(keys))
+            is_ovr |= parcels['parcelid'].isin(ovr.loc[rows, 'parcelid']).to_numpy()
+
+    # Parcels left to the zone pool once override parcels are taken out
+    hh_pool = (pcl_group >= 0) & ~hh_ovr_parcel
+    emp_pool = (pcl_group >= 0) & ~emp_ovr_parcel
+    # Parcels the household draw can use: zones fall back to uniform weights only when none of their
+    # parcels has households, before override parcels are taken out of the draw
+    pcl_id, pcl_taz, weight, _ = allocation.parcel_weights(parcels, keys, use_capacities)
+    drawable = (weight > 0) & ~np.isin(pcl_id, parcels['parcelid'].to_numpy()[hh_ovr_parcel])
+    hh_parcels = np.bincount(allocation.lookup_groups(keys, pcl_taz[drawable]), minlength=len(keys))
+    emp_parcels = np.bincount(pcl_group[emp_pool], minlength=len(keys))
+    capacity = np.bincount(pcl_group[hh_pool], weights=parcels['hh_u'].to_numpy()[hh_pool], minlength=len(keys))
+    demand = households - np.minimum(ovr_hh, households)
+
+    checks = [('override_exceeds_households', ovr_hh > households, ovr_hh, households)]
+    if crosswalk is not None:
+        missing = ~np.isin(keys, crosswalk['taz_id'].to_numpy()) & (households > 0)
+        checks.append(('missing_from_crosswalk', missing, households, np.full(len(keys), np.nan)))
+    if use_capacities:
+        checks.append(('insufficient_capacity', demand > capacity, demand, capacity))
+    else:
+        checks.append(('no_parcels_for_households', (demand > 0) & (hh_parcels == 0), demand, hh_parcels))
+    if update_jobs:
+        checks.append(('no_parcels_for_jobs', (employment > ovr_emp) & (emp_parcels == 0), employment - ovr_emp, emp_parcels))
+        checks.append(('override_exceeds_employment', ovr_emp > employment, ovr_emp, employment))
+
+    violations = pd.concat([pd.DataFrame({'taz_id': keys[bad], 'check': name, 'value': value[bad], 'limit': limit[bad]})
+                            for name, bad, value, limit in checks], ignore_index=True)
+    violations.insert(2, 'severity', np.where(violations['check'].isin(blocking_checks), 'error', 'warning'))
+
+    return violations.sort_values(['taz_id', 'check'], kind='mergesort').reset_index(drop=True)
+
+
+def report_violations(violations, path):
+    """Write the violations report and stop if any violation is an error"""
+
+    violations.to_csv(path, index=False)
+    if len(violations) == 0:
+        return
+    print("Input checks found {} problem(s) in {} TAZ(s), written to {}".format(
+        len(violations), violations['taz_id'].nunique(), path))
+    print(violations.groupby(['check', 'severity']).size().rename('tazs').reset_index().to_string(index=False))
+    if (violations['severity'] == 'error').any():
+        print("Please adjust inputs before running PopulationSim")
+        sys.exit(1)
@@ -0,0 +1,100 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Run profiling for allocate_hh.py and generate_controls.py --profile
+# Stages are wrapped in profile_stage(), which records wall and CPU time, the peak resident
+# memory of the process so far and the rows going in and out of the stage. A report is a list
+# of these entries; it is None when profiling is off, in which case nothing is measured.
+# One stage can also be run under cProfile, with the statistics dumped to a .prof file.
+
+import os
+import sys
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then reported through psutil if installed
+    resource = None
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None if it cannot be measured"""
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+
+    return getattr(info, 'peak_wset', info.rss) / 1e6
+
+
+def new_report(profile_stage_name=None, output_dir=None):
+    """Empty run report; profile_stage_name selects a stage to run under cProfile"""
+
+    return {'stages': [], 'tables': {}, 'cprofile_stage': profile_stage_name, 'output_dir': output_dir}
+
+
+@contextmanager
+def profile_stage(report, name, rows_in=None):
+    """Measure the enclosed block as stage name; the caller can set entry['rows_out']"""
+
+    entry = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    if report is None:
+        yield entry
+        return
+
+    profiler = None
+    if report['cprofile_stage'] == name:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield entry
+    finally:
+        entry['wall_s'] = time.perf_counter() - wall
+        entry['cpu_s'] = time.process_time() - cpu
+        entry['peak_rss_mb'] = peak_rss_mb()
+        if profiler is not None:
+            profiler.disable()
+            if not os.path.exists(str(report['output_dir'])):
+                os.makedirs(str(report['output_dir']))
+            profiler.dump_stats(os.path.join(str(report['output_dir']), name + '.prof'))
+        report['stages'].append(entry)
+
+
+def write_report(report):
+    """Write run_report.json and run_report.csv, plus the report's extra tables as CSV"""
+
+    output_dir = str(report['output_dir'])
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    stages = pd.DataFrame(report['stages'])
+    stages.to_csv(os.path.join(output_dir, 'run_report.csv'), index=False)
+    with open(os.path.join(output_dir, 'run_report.json'), 'w') as f:
+        json.dump({'stages': report['stages']}, f, indent=2, default=float)
+    for name, df in report['tables'].items():
+        df.to_csv(os.path.join(output_dir, name + '.csv'), index=False)
+
+    print(stages.to_string(index=False))
@@ -0,0 +1,66 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Compact column dtypes for parcel, household and person tables
+# Tables are cast to these dtypes when loaded and keep them through allocation; records are only
+# widened to the dtypes of the Soundcast files when written. IDs and TAZs are int32, which also
+# serve as the integer TAZ codes used for grouping, and category codes are int8.
+
+import numpy as np
+
+emp_cols = ['empedu_p', 'empfoo_p', 'empgov_p', 'empind_p', 'empmed_p', 'empofc_p', 'empoth_p', 'empret_p', 'emprsc_p', 'empsvc_p']
+
+parcel_dtypes = dict({'parcelid': 'int32', 'taz_p': 'int32', 'hh_p': 'int32', 'hh_u': 'int32',
+                      'sfunits': 'int32', 'mfunits': 'int32', 'emptot_p': 'int32'},
+                     **{col: 'int32' for col in emp_cols})
+
+# PopulationSim synthetic households and persons
+synth_household_dtypes = {'household_id': 'int32', 'taz_id': 'int32', 'hh_id': 'int32', 'PUMA': 'int32',
+                          'NP': 'int8', 'HINCP': 'int32', 'TEN': 'int8', 'worker_count': 'int8', 'VEH': 'int8'}
+synth_person_dtypes = {'household_id': 'int32', 'hh_id': 'int32', 'per_num': 'int8', 'AGEP': 'int8', 'SEX': 'int8',
+                       'WKHP': 'int8', 'SCH': 'int8', 'SCHG': 'int8', 'RAC1P': 'int8', 'HISP': 'int8'}
+
+# Soundcast hh_and_persons.h5 records
+household_dtypes = {'hhno': 'int32', 'hhparcel': 'int32', 'hhtaz': 'int32', 'hhsize': 'int8', 'hhincome': 'int32'}
+person_dtypes = {'hhno': 'int32', 'pno': 'int8', 'pagey': 'int8', 'pgend': 'int8', 'pwtyp': 'int8', 'pstyp': 'int8', 'pptyp': 'int8'}
+
+
+def apply_schema(df, dtypes):
+    """Cast the columns of df listed in dtypes, in place
+
+    Columns with missing values, or with values outside the range of the compact dtype,
+    keep their dtype. Float columns are only cast when they hold whole numbers.
+    """
+
+    for col, dtype in dtypes.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        values = df[col].to_numpy()
+        if not (np.issubdtype(values.dtype, np.integer) or np.issubdtype(values.dtype, np.floating)):
+            continue
+        if len(values) > 0:
+            if np.issubdtype(values.dtype, np.floating) and (np.isnan(values).any() or (values != np.round(values)).any()):
+                continue
+            info = np.iinfo(dtype)
+            if values.min() < info.min or values.max() > info.max:
+                continue
+        df[col] = values.astype(dtype)
+
+    return df
+
+
+def round_to(values, dtype):
+    """Round half to even, as Python's round(), and cast to an integer dtype"""
+
+    return np.round(np.asarray(values, dtype='float64')).astype(dtype)
@@ -0,0 +1,121 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# PopulationSim seed households and persons for the study area PUMAs
+# The statewide PUMS seed CSVs are converted once into a store of Feather files, one per PUMA
+# for households and for persons (persons are placed in the PUMA of their household). Only the
+# partitions of the study area PUMAs are read after that. The extract for a set of PUMAs is also
+# cached as the CSV files PopulationSim reads, so repeated runs over the same study area only
+# copy them. Both caches are rebuilt when the seed files change.
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import parcel_io
+
+# Original row number, used to return extracts in the order of the seed files
+row_col = '_seed_row'
+
+
+def source_meta(paths):
+    """Size, modification time and hash of each seed file"""
+
+    meta = {}
+    for name, path in paths.items():
+        stat = os.stat(path)
+        meta[name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': parcel_io.file_hash(path)}
+
+    return meta
+
+
+def store_is_valid(store_dir, paths):
+    """Check that the store was built from the current seed files"""
+
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    meta = json.load(open(meta_path))
+
+    return all(name in meta and parcel_io.cache_is_valid(path, meta[name]) for name, path in paths.items())
+
+
+def partition_path(store_dir, table, puma):
+    return os.path.join(store_dir, '{}_{}.feather'.format(table, int(puma)))
+
+
+def build_seed_store(paths, store_dir):
+    """Split the seed households and persons into one Feather file per PUMA"""
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.makedirs(store_dir)
+
+    seed_hh = pd.read_csv(paths['households'])
+    seed_hh[row_col] = np.arange(len(seed_hh))
+    seed_persons = pd.read_csv(paths['persons'])
+    seed_persons[row_col] = np.arange(len(seed_persons))
+    person_puma = seed_persons['hhnum'].map(seed_hh.drop_duplicates('hhnum').set_index('hhnum')['PUMA'])
+
+    for puma, df in seed_hh.groupby('PUMA'):
+        feather.write_feather(df.reset_index(drop=True), partition_path(store_dir, 'households', puma))
+    for puma, df in seed_persons.groupby(person_puma):
+        feather.write_feather(df.reset_index(drop=True), partition_path(store_dir, 'persons', puma))
+
+    # Written last so that an interrupted build is not taken as valid
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump(source_meta(paths), f)
+
+
+def read_partitions(store_dir, table, pumas, columns):
+    """Records of a table for the given PUMAs, in the order of the seed file"""
+
+    frames = [feather.read_table(partition_path(store_dir, table, puma), memory_map=True).to_pandas()
+              for puma in pumas if os.path.exists(partition_path(store_dir, table, puma))]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames).sort_values(row_col)
+
+    return df.drop(columns=row_col).reset_index(drop=True)
+
+
+def prepare_seed_files(hh_path, person_path, pumas, cache_dir, data_dir):
+    """Write seed_households.csv and seed_persons.csv for the given PUMAs to data_dir
+
+    The extract is copied from cache_dir when it was made for the same PUMAs and seed files;
+    otherwise it is read from the PUMA store, which is built first if needed.
+    """
+
+    paths = {'households': str(hh_path), 'persons': str(person_path)}
+    store_dir = os.path.join(str(cache_dir), 'seed_store')
+    if not store_is_valid(store_dir, paths):
+        print("Building PUMA seed store from {}".format(hh_path))
+        build_seed_store(paths, store_dir)
+    meta = json.load(open(os.path.join(store_dir, 'meta.json')))
+
+    pumas = sorted(int(puma) for puma in np.unique(pumas))
+    key = json.dumps([pumas, meta['households']['sha1'], meta['persons']['sha1']])
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    extract = {name: os.path.join(str(cache_dir), 'seed_{}_{}.csv'.format(name, key)) for name in paths}
+
+    if not all(os.path.exists(path) for path in extract.values()):
+        for name in paths:
+            columns = [col for col in pd.read_csv(paths[name], nrows=0).columns]
+            read_partitions(store_dir, name, pumas, columns).to_csv(extract[name], index=False)
+
+    shutil.copyfile(extract['households'], os.path.join(str(data_dir), 'seed_households.csv'))
+    shutil.copyfile(extract['persons'], os.path.join(str(data_dir), 'seed_persons.csv'))
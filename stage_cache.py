@@ -0,0 +1,97 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Skip pipeline stages whose inputs have not changed since the last run
+# allocate_hh.py runs as a chain of stages (controls -> PopulationSim -> allocation and export).
+# Each stage is keyed on the content hashes of its input files and the config settings it uses.
+# After a stage runs, its key and the hashes of its output files are recorded in a manifest; a
+# later run skips the stage when the key matches and its outputs are still the files it wrote.
+# Stages are linked through their files, so a stage that reproduces identical outputs does not
+# trigger the stages after it. File hashes are kept with the size and modification time of
+# each file so unchanged files are not read again.
+
+import os
+import json
+import hashlib
+import parcel_io
+
+
+def load_manifest(path, enabled=True):
+    """Stage manifest from a previous run, or None if stage caching is disabled"""
+
+    if not enabled:
+        return None
+    manifest = {'path': str(path), 'stages': {}, 'files': {}}
+    if os.path.exists(path):
+        manifest.update(json.load(open(path)))
+
+    return manifest
+
+
+def save_manifest(manifest):
+    """Write the stage manifest to its cache file"""
+
+    cache_dir = os.path.dirname(manifest['path'])
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(manifest['path'], 'w') as f:
+        json.dump({key: manifest[key] for key in ['stages', 'files']}, f, indent=2)
+
+
+def content_hash(manifest, path):
+    """SHA-1 of a file's contents, reusing the recorded hash while size and modification time match"""
+
+    if path is None or not os.path.exists(path):
+        return None
+    path = os.path.abspath(str(path))
+    stat = os.stat(path)
+    known = manifest['files'].get(path)
+    if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+        return known['sha1']
+    sha1 = parcel_io.file_hash(path)
+    manifest['files'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1}
+
+    return sha1
+
+
+def stage_key(manifest, inputs, settings):
+    """Hash of the stage's input file contents and config settings"""
+
+    key = json.dumps([[content_hash(manifest, path) for path in inputs], settings], sort_keys=True, default=str)
+
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def run_stage(manifest, name, func, inputs, settings, outputs):
+    """Run func unless the stage's inputs, settings and outputs match its last recorded run
+
+    Returns True if the stage was run.
+    """
+
+    if manifest is None:
+        func()
+        return True
+
+    key = stage_key(manifest, inputs, settings)
+    previous = manifest['stages'].get(name)
+    if (previous is not None and previous['key'] == key and
+            all(content_hash(manifest, path) == previous['outputs'].get(str(path)) for path in outputs)):
+        print("Skipping {}: inputs unchanged since the last run".format(name))
+        return False
+
+    func()
+    manifest['stages'][name] = {'key': key, 'outputs': {str(path): content_hash(manifest, path) for path in outputs}}
+    save_manifest(manifest)
+
+    return True
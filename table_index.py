@@ -0,0 +1,106 @@
+#Copyright [2022] [Puget Sound Regional Council]
+
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+# Integer indexes over the key columns of the parcel, household and person tables
+# An index is built once from a key column. It holds the row numbers sorted by key and the
+# unique keys with the start/end offsets of their rows in that order (CSR layout), so it maps
+# parcelid to a parcel row, a TAZ to its parcel rows or a household to its person rows.
+# Tables are then joined by gathering columns at the looked-up rows, and the rows of a set of
+# keys are selected from their offsets, instead of merging or scanning with isin.
+
+import numpy as np
+import pandas as pd
+import allocation
+
+
+def build_index(keys):
+    """Index of a key column: row order by key, unique keys and their row offsets in that order"""
+
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind='stable')
+    unique, start, end = allocation.group_offsets(keys[order])
+
+    return {'order': order, 'keys': unique, 'start': start, 'end': end}
+
+
+def key_positions(index, values):
+    """Position of each value in the index keys, -1 where the key is not in the index"""
+
+    return allocation.lookup_groups(index['keys'], np.asarray(values))
+
+
+def group_sum(index, values):
+    """Sum of a column over the rows of each key, in the order of the index keys"""
+
+    values = np.asarray(values)[index['order']]
+    if len(index['start']) == 0:
+        return np.zeros(0, dtype=values.dtype)
+
+    return np.add.reduceat(values, index['start'])
+
+
+def lookup_rows(index, values):
+    """First row of each value's key, -1 where the key is not in the index"""
+
+    pos = allocation.lookup_groups(index['keys'], np.asarray(values))
+    if len(index['keys']) == 0:
+        return pos
+
+    return np.where(pos >= 0, index['order'][index['start'][np.maximum(pos, 0)]], -1)
+
+
+def group_rows(index, values):
+    """Rows of all the given keys, key by key in the order of values and in table order within a key"""
+
+    pos = allocation.lookup_groups(index['keys'], np.asarray(values))
+    pos = pos[pos >= 0]
+    start = index['start'][pos]
+    counts = index['end'][pos] - start
+    offset = np.cumsum(counts) - counts
+
+    return index['order'][np.repeat(start - offset, counts) + np.arange(counts.sum())]
+
+
+def key_mask(index, values):
+    """Boolean mask of the rows whose key is in values"""
+
+    mask = np.zeros(len(index['order']), dtype=bool)
+    mask[group_rows(index, np.unique(np.asarray(values)))] = True
+
+    return mask
+
+
+def take(values, rows):
+    """Values at the given rows, NaN where the row is -1, as in a left merge"""
+
+    values = np.asarray(values)
+    missing = rows < 0
+    if not missing.any():
+        return values[rows]
+    if len(values) == 0:
+        return np.full(len(rows), np.nan)
+    result = values[np.maximum(rows, 0)]
+    result = result.astype('object' if result.dtype.kind in 'OUS' else 'float64')
+    result[missing] = np.nan
+
+    return result
+
+
+def join(df, other, rows):
+    """Copy of df with the columns of other not already in df, gathered at the given rows of other"""
+
+    df = df.reset_index(drop=True)
+    gathered = {col: take(other[col].to_numpy(), rows) for col in other.columns if col not in df.columns}
+
+    return pd.concat([df, pd.DataFrame(gathered, index=df.index)], axis=1)